@@ -0,0 +1,213 @@
+"""Invoice Processor Export Module:
+    Backfilling past months with per-month checkpoints so interrupted runs resume
+"""
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+from export_modules.gcal import GCal
+
+class Backfill:
+    """Backfill class:
+        - Splits a range of months into one chunk per month
+        - Google Calendar months run concurrently, each thread with its own export and connection
+        - PPM months run one at a time as they share the browser and Downloads folder
+        - Each chunk is checkpointed in the source database, done months are skipped on resume
+    """
+    def __init__(self, _gcal, _ppm, _workers=4, _expand_recurring=False, _refresh_ppm=False):
+        self.gcal = _gcal
+        self.ppm = _ppm
+        self._workers = max(_workers, 1)
+        self._expand_recurring = _expand_recurring
+        self._refresh_ppm = _refresh_ppm
+        for source in (self.gcal, self.ppm):
+            # Wait for the export threads' commits instead of failing as locked
+            source.util.db_cur.execute("PRAGMA busy_timeout = 60000")
+            self.create_tables(source.util)
+
+    @staticmethod
+    def create_tables(_util):
+        """Create the checkpoint table if it doesn't exist
+
+        Args:
+            _util (ExportUtil): source database
+        """
+        _util.db_cur.execute(
+            """CREATE TABLE IF NOT EXISTS backfill_checkpoint (
+                source TEXT,
+                period TEXT,
+                status TEXT,
+                updated_at TEXT,
+                error TEXT,
+                PRIMARY KEY (source, period)
+            )"""
+        )
+        _util.commit_db()
+
+    @staticmethod
+    def periods(_start, _end):
+        """Months from start to end inclusive
+
+        Args:
+            _start (str): first month (YYYY-MM)
+            _end (str): last month (YYYY-MM)
+
+        Returns:
+            list: months (YYYY-MM)
+        """
+        year, month = (int(part) for part in _start.split("-"))
+        end_year, end_month = (int(part) for part in _end.split("-"))
+
+        periods = []
+        while (year, month) <= (end_year, end_month):
+            periods.append(f"{year:04d}-{month:02d}")
+            year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+        return periods
+
+    @staticmethod
+    def checkpoint(_util, _source, _period, _status, _error=None):
+        """Record the status of a chunk
+
+        Args:
+            _util (ExportUtil): source database
+            _source (str): gcal or ppm
+            _period (str): month (YYYY-MM)
+            _status (str): running, done or failed
+            _error (str): error when failed
+        """
+        _util.db_cur.execute(
+            """INSERT INTO backfill_checkpoint VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT (source, period) DO UPDATE SET
+                    status = excluded.status,
+                    updated_at = excluded.updated_at,
+                    error = excluded.error""",
+            (_source, _period, _status, datetime.now().isoformat(timespec="seconds"), _error)
+        )
+        _util.commit_db()
+
+    @staticmethod
+    def pending(_util, _source, _periods, _restart=False):
+        """Months not yet done, clearing their checkpoints first on restart
+
+        Args:
+            _util (ExportUtil): source database
+            _source (str): gcal or ppm
+            _periods (list): months (YYYY-MM)
+            _restart (bool): export every month again
+
+        Returns:
+            list: months (YYYY-MM) still to export
+        """
+        if _restart:
+            _util.db_cur.executemany(
+                "DELETE FROM backfill_checkpoint WHERE source = ? AND period = ?",
+                [(_source, period) for period in _periods]
+            )
+            _util.commit_db()
+
+        _util.db_cur.execute(
+            "SELECT period FROM backfill_checkpoint WHERE source = ? AND status = 'done'",
+            (_source,)
+        )
+        done = {row[0] for row in _util.db_cur.fetchall()}
+        return [period for period in _periods if period not in done]
+
+    def run(self, _start, _end, _sources=("gcal", "ppm"), _restart=False):
+        """Backfill every month in the range for each source
+
+        Args:
+            _start (str): first month (YYYY-MM)
+            _end (str): last month (YYYY-MM)
+            _sources (list): gcal and/or ppm
+            _restart (bool): export every month again
+
+        Returns:
+            dict: source and the months that failed
+        """
+        periods = self.periods(_start, _end)
+        failed = {}
+        if "gcal" in _sources:
+            failed["gcal"] = self.run_gcal(self.pending(self.gcal.util, "gcal", periods, _restart))
+        if "ppm" in _sources:
+            failed["ppm"] = self.run_ppm(self.pending(self.ppm.util, "ppm", periods, _restart))
+        return failed
+
+    def run_gcal(self, _periods):
+        """Export Google Calendar months concurrently
+
+        Args:
+            _periods (list): months (YYYY-MM)
+
+        Returns:
+            list: months that failed
+        """
+        failed = []
+        if not _periods:
+            print("Google Calendar backfill already done")
+            return failed
+
+        with ThreadPoolExecutor(max_workers=min(self._workers, len(_periods))) as executor:
+            futures = {executor.submit(self.export_gcal, period): period for period in _periods}
+            for future in as_completed(futures):
+                period = futures[future]
+                error = future.result()
+                self.checkpoint(self.gcal.util, "gcal", period, "failed" if error else "done", error)
+                if error:
+                    failed.append(period)
+                    print(f"Google Calendar {period} failed: {error}")
+                else:
+                    print(f"Google Calendar {period} done")
+
+        return sorted(failed)
+
+    def export_gcal(self, _period):
+        """Export a Google Calendar month on its own connection and session
+
+        Args:
+            _period (str): month (YYYY-MM)
+
+        Returns:
+            str: error, None when the month was exported
+        """
+        gcal = GCal(self._expand_recurring)
+        try:
+            gcal.util.db_cur.execute("PRAGMA busy_timeout = 60000")
+            self.checkpoint(gcal.util, "gcal", _period, "running")
+            if not gcal.export(datetime.strptime(_period + "-01", "%Y-%m-%d")):
+                return "export failed"
+            return None
+        except Exception as error: # pylint: disable=broad-except
+            return str(error)
+        finally:
+            gcal.util.disconnect_db()
+
+    def run_ppm(self, _periods):
+        """Export PPM months one at a time
+
+        Args:
+            _periods (list): months (YYYY-MM)
+
+        Returns:
+            list: months that failed
+        """
+        failed = []
+        if not _periods:
+            print("PPM backfill already done")
+            return failed
+
+        for period in _periods:
+            self.checkpoint(self.ppm.util, "ppm", period, "running")
+            error = None
+            try:
+                if not self.ppm.export(datetime.strptime(period + "-01", "%Y-%m-%d"), self._refresh_ppm):
+                    error = "export failed"
+            except Exception as exception: # pylint: disable=broad-except
+                error = str(exception)
+
+            self.checkpoint(self.ppm.util, "ppm", period, "failed" if error else "done", error)
+            if error:
+                failed.append(period)
+                print(f"PPM {period} failed: {error}")
+            else:
+                print(f"PPM {period} done")
+
+        return failed
@@ -2,27 +2,42 @@
     Exporting calendar events from Google Calendar (GCal)
 """
 
+from datetime import timezone
+import json
 import os
 from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
 from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
+from dateutil import rrule, tz
 from dateutil.parser import parse as dtparse
+from export_modules.quota import QuotaManager
+from export_modules.retention import Retention
 from export_modules.util import ExportUtil
 
 class GCal:
     """Google Calendar export class
     """
-    def __init__(self):
+    # Only the event fields that are saved
+    EVENT_FIELDS = (
+        "nextPageToken,"
+        "items(id,etag,status,summary,start,end,recurrence,recurringEventId,originalStartTime)"
+    )
+
+    def __init__(self, _expand_recurring=False):
         self.util = ExportUtil()
+        self._expand_recurring = _expand_recurring
         self._dates = self.util.set_dates()
         self._db_name = "gcal.db"
         if not os.path.isfile(self._db_name):
             open(self._db_name, "w", encoding="utf-8").close()
 
         self.util.connect_db(self._db_name)
+        self.create_tables()
         self._credentials = self.get_credentials("gauth-credentials.json")
+        self._service = None
+        self.quota = QuotaManager()
 
     def __del__(self):
         self.util.disconnect_db()
@@ -32,17 +47,32 @@ class GCal:
 
         Args:
             _date (date): run date
+
+        Returns:
+            bool: True when the month was exported
         """
         self._dates = self.util.set_dates(_date)
+        exported = False
         if self._credentials is not None:
             try:
-                service = build("calendar", "v3", credentials=self._credentials)
-                self.save_db(service)
+                # Build once and reuse the session for later exports
+                if self._service is None:
+                    self._service = build("calendar", "v3", credentials=self._credentials)
+                self.save_db(self._service)
+                exported = True
             except HttpError as error:
                 print(f"An error occurred: {error}")
+
+            print(
+                f"Google API requests: {self.quota.stats['requests']}, "
+                f"retries: {self.quota.stats['retries']}, "
+                f"throttled: {self.quota.stats['throttled_seconds']:.1f}s"
+            )
         else:
             print("No valid credentials.json file found.")
 
+        return exported
+
     @staticmethod
     def get_credentials(_secret):
         """Use Google Calendar API to get Credentials OAuth 2.0 client secret
@@ -78,11 +108,8 @@ class GCal:
         else:
             print("Missing gauth-credentials.json")
 
-    def save_db(self, _service):
-        """For each calendar id call Google Calendar Events API and save to sqlite db table calendar
-
-        Args:
-            _service (object build): Google Calendar build object
+    def create_tables(self):
+        """Create the calendar table, adding the event key to tables from older versions
         """
         self.util.db_cur.execute(
             """CREATE TABLE IF NOT EXISTS calendar (
@@ -90,23 +117,50 @@ class GCal:
                 title REAL,
                 start TEXT,
                 end TEXT,
-                duration REAL
+                duration REAL,
+                event_id TEXT,
+                instance_start TEXT
             )"""
         )
+        self.util.add_columns("calendar", {"event_id": "TEXT", "instance_start": "TEXT"})
 
         # Create index over timesheet dates if it doesn't exist
         self.util.db_cur.execute(
             """CREATE INDEX IF NOT EXISTS calendar_date_index ON calendar (start)"""
         )
 
+        # Natural key for upserts, rows from older versions have a null event_id
         self.util.db_cur.execute(
-            "DELETE FROM calendar WHERE start BETWEEN ? and ?",
-            (self._dates["fom_isoz"], self._dates["eom_isoz"])
+            """CREATE UNIQUE INDEX IF NOT EXISTS calendar_key_index
+                ON calendar (calendar, event_id, instance_start)"""
         )
 
+        # Recurring series expanded locally for a date range
+        self.util.db_cur.execute(
+            """CREATE TABLE IF NOT EXISTS recurrence_cache (
+                calendar TEXT,
+                event_id TEXT,
+                window_start TEXT,
+                etag TEXT,
+                instances TEXT,
+                PRIMARY KEY (calendar, event_id, window_start)
+            )"""
+        )
+
+        self.util.commit_db()
+
+    def save_db(self, _service):
+        """For each calendar id call Google Calendar Events API and upsert to sqlite db table calendar
+
+        Events are keyed by calendar, event id and instance start so only changed events are
+        written. Events in the date range that Google no longer returns are removed.
+
+        Args:
+            _service (object build): Google Calendar build object
+        """
         # Get calendar ids
         calendars = []
-        calendar_list = _service.calendarList().list().execute()
+        calendar_list = self.quota.execute(_service.calendarList().list())
         for calendar_list_entry in calendar_list["items"]:
             calendars.append(calendar_list_entry["id"])
 
@@ -117,34 +171,241 @@ class GCal:
         for cal_id in calendars:
 
             # Call the Calendar API
-            events_result = _service.events().list(
-                calendarId=cal_id,
-                timeMin=self._dates["fom_isoz"],
-                singleEvents=True,
-                orderBy="startTime"
-            ).execute()
-            events = events_result.get("items", [])
+            if self._expand_recurring:
+                events = self.expand_events(cal_id, self.list_events(_service, cal_id, False))
+            else:
+                events = self.list_events(_service, cal_id, True)
 
             if not events:
                 print("No events found for calendar: " + cal_id + ".")
-            else:
-                # Insert all the events for last month
-                for event in events:
-                    start = event["start"].get("dateTime", event["start"].get("date"))
-                    end = event["end"].get("dateTime", event["end"].get("date"))
-                    summary = "(No title)"
-                    if "summary" in event:
-                        summary = event["summary"]
-                    time_diff = dtparse(end) - dtparse(start)
-
-                    # in fractional hours
-                    duration = int(round(time_diff.total_seconds() / 60))
-
-                    # Insert events that fall within date range
-                    if self._dates["fom_isoz"] <= start <= self._dates["eom_isoz"]:
-                        self.util.db_cur.execute(
-                            "INSERT INTO calendar VALUES (?, ?, ?, ?, ?)",
-                            (cal_id, summary, start, end, duration)
-                        )
 
-        self.util.commit_db()
+            # Insert all the events for last month
+            seen = set()
+            for event in events:
+                start = event["start"].get("dateTime", event["start"].get("date"))
+                end = event["end"].get("dateTime", event["end"].get("date"))
+                summary = "(No title)"
+                if "summary" in event:
+                    summary = event["summary"]
+                time_diff = dtparse(end) - dtparse(start)
+
+                # in fractional hours
+                duration = int(round(time_diff.total_seconds() / 60))
+
+                # Recurring instances keep their original start when moved
+                instance_start = ""
+                if "originalStartTime" in event:
+                    instance_start = event["originalStartTime"].get(
+                        "dateTime", event["originalStartTime"].get("date")
+                    )
+
+                # Upsert events that fall within date range
+                if self._dates["fom_isoz"] <= start <= self._dates["eom_isoz"]:
+                    seen.add((event["id"], instance_start))
+                    self.upsert_event(
+                        (cal_id, summary, start, end, duration, event["id"], instance_start)
+                    )
+
+            self.remove_events(cal_id, seen)
+            self.util.commit_db()
+
+    def remove_events(self, _cal_id, _seen):
+        """Remove events in the date range that Google no longer returns for a calendar,
+        including from the archives when the range was archived
+
+        Args:
+            _cal_id (str): calendar id
+            _seen (set): (event id, instance start) returned by Google
+        """
+        retention = Retention(self.util, "calendar")
+        retention.attach(self._dates["fom_isoz"], self._dates["eom_isoz"])
+        try:
+            for schema in retention.schemas():
+                self.util.db_cur.execute(
+                    f"""SELECT rowid, event_id, instance_start FROM {schema}.calendar
+                        WHERE calendar = ? AND start BETWEEN ? and ?""",
+                    (_cal_id, self._dates["fom_isoz"], self._dates["eom_isoz"])
+                )
+                removed = [
+                    (row[0],) for row in self.util.db_cur.fetchall() if (row[1], row[2]) not in _seen
+                ]
+                self.util.db_cur.executemany(f"DELETE FROM {schema}.calendar WHERE rowid = ?", removed)
+        finally:
+            retention.detach()
+
+    def list_events(self, _service, _cal_id, _single_events):
+        """Call the Calendar API for every page of events in the date range
+
+        Args:
+            _service (object build): Google Calendar build object
+            _cal_id (str): calendar id
+            _single_events (bool): let Google expand recurring events into instances
+
+        Returns:
+            list: event resources
+        """
+        params = {
+            "calendarId": _cal_id,
+            "timeMin": self._dates["fom_isoz"],
+            "timeMax": self._dates["eom_isoz"],
+            "singleEvents": _single_events,
+            "fields": self.EVENT_FIELDS
+        }
+        if _single_events:
+            params["orderBy"] = "startTime"
+
+        events = []
+        page_token = None
+        while True:
+            events_result = self.quota.execute(_service.events().list(pageToken=page_token, **params))
+            events += events_result.get("items", [])
+            page_token = events_result.get("nextPageToken")
+            if page_token is None:
+                return events
+
+    def expand_events(self, _cal_id, _events):
+        """Expand recurring master events into instances locally, applying their exceptions
+
+        Args:
+            _cal_id (str): calendar id
+            _events (list): event resources listed without singleEvents
+
+        Returns:
+            list: event resources in the same shape as singleEvents=True
+        """
+        masters = []
+        exceptions = {}
+        events = []
+        for event in _events:
+            if "recurrence" in event:
+                masters.append(event)
+            elif "recurringEventId" in event:
+                key = (event["recurringEventId"], self.instance_key(event["originalStartTime"]))
+                exceptions[key] = event
+            elif event.get("status") != "cancelled":
+                events.append(event)
+
+        for master in masters:
+            for instance_id, start, end in self.expand_series(_cal_id, master):
+                time_key = "dateTime" if "dateTime" in master["start"] else "date"
+                key = (master["id"], self.instance_key({time_key: start}))
+
+                # Moved or cancelled instances
+                if key in exceptions:
+                    continue
+
+                events.append({
+                    "id": instance_id,
+                    "summary": master.get("summary", "(No title)"),
+                    "start": {time_key: start},
+                    "end": {time_key: end},
+                    "originalStartTime": {time_key: start}
+                })
+
+        events += [event for event in exceptions.values() if event.get("status") != "cancelled"]
+
+        return events
+
+    @staticmethod
+    def instance_key(_time):
+        """Normalize an event time so instances from different sources can be matched
+
+        Args:
+            _time (dict): event time with dateTime or date
+
+        Returns:
+            str: UTC date time or date
+        """
+        if "dateTime" in _time:
+            return dtparse(_time["dateTime"]).astimezone(timezone.utc).isoformat()
+        return _time["date"]
+
+    def expand_series(self, _cal_id, _master):
+        """Expand the RRULE and EXDATE of a recurring master event for the date range
+
+        Expansions are cached by etag so unchanged series are not expanded again.
+
+        Args:
+            _cal_id (str): calendar id
+            _master (dict): recurring master event resource
+
+        Returns:
+            list: (instance id, start, end) in the formats Google uses for instances
+        """
+        self.util.db_cur.execute(
+            """SELECT instances FROM recurrence_cache
+                WHERE calendar = ? AND event_id = ? AND window_start = ? AND etag = ?""",
+            (_cal_id, _master["id"], self._dates["fom_isoz"], _master.get("etag"))
+        )
+        cached = self.util.db_cur.fetchone()
+        if cached is not None:
+            return json.loads(cached[0])
+
+        rules = "\n".join(
+            line for line in _master["recurrence"] if line.startswith(("RRULE", "EXRULE", "RDATE", "EXDATE"))
+        )
+
+        instances = []
+        if "dateTime" in _master["start"]:
+            # Expand in the event time zone so instances keep their wall clock time across DST
+            start = dtparse(_master["start"]["dateTime"])
+            event_tz = tz.gettz(_master["start"].get("timeZone"))
+            if event_tz is not None:
+                start = start.astimezone(event_tz)
+            duration = dtparse(_master["end"]["dateTime"]) - dtparse(_master["start"]["dateTime"])
+
+            series = rrule.rrulestr(rules, dtstart=start, forceset=True)
+            for instance in series.between(
+                self._dates["fom"].replace(tzinfo=timezone.utc),
+                self._dates["eom"].replace(tzinfo=timezone.utc),
+                inc=True
+            ):
+                instance_utc = instance.astimezone(timezone.utc)
+                instances.append((
+                    f"{_master['id']}_{instance_utc.strftime('%Y%m%dT%H%M%SZ')}",
+                    instance.isoformat(),
+                    (instance + duration).isoformat()
+                ))
+        else:
+            # All-day events
+            start = dtparse(_master["start"]["date"])
+            duration = dtparse(_master["end"]["date"]) - start
+
+            series = rrule.rrulestr(rules, dtstart=start, forceset=True)
+            for instance in series.between(self._dates["fom"], self._dates["eom"], inc=True):
+                instances.append((
+                    f"{_master['id']}_{instance.strftime('%Y%m%d')}",
+                    instance.date().isoformat(),
+                    (instance + duration).date().isoformat()
+                ))
+
+        self.util.db_cur.execute(
+            """INSERT INTO recurrence_cache VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT (calendar, event_id, window_start) DO UPDATE SET
+                    etag = excluded.etag,
+                    instances = excluded.instances""",
+            (_cal_id, _master["id"], self._dates["fom_isoz"], _master.get("etag"), json.dumps(instances))
+        )
+
+        return instances
+
+    def upsert_event(self, _event):
+        """Insert an event or update it when any of its values changed
+
+        Args:
+            _event (tuple): calendar, title, start, end, duration, event_id, instance_start
+        """
+        self.util.db_cur.execute(
+            """INSERT INTO calendar (calendar, title, start, end, duration, event_id, instance_start)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (calendar, event_id, instance_start) DO UPDATE SET
+                    title = excluded.title,
+                    start = excluded.start,
+                    end = excluded.end,
+                    duration = excluded.duration
+                WHERE title IS NOT excluded.title
+                    OR start IS NOT excluded.start
+                    OR end IS NOT excluded.end
+                    OR duration IS NOT excluded.duration""",
+            _event
+        )
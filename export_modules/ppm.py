@@ -2,12 +2,16 @@
     Exporting timesheets from Microsoft Project Portfolio Management (PPM)
 """
 
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime, timedelta
+from itertools import repeat
 from pathlib import Path
 import glob
+import hashlib
 import os
+import shutil
 import time
-import pandas as pd
+from openpyxl import load_workbook
 from selenium import webdriver
 from selenium.webdriver.chrome.service import Service
 from selenium.webdriver.common.keys import Keys
@@ -15,6 +19,7 @@ from selenium.webdriver.common.by import By
 from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver.support import expected_conditions as EC
 from webdriver_manager.chrome import ChromeDriverManager
+from export_modules.retention import Retention
 from export_modules.util import ExportUtil
 
 class PPM:
@@ -24,46 +29,162 @@ class PPM:
         self.util = ExportUtil()
         self._path_downloads = str(Path.home() / "Downloads")
         self._file_name = "My+Timesheet*.xlsx"
+        self._path_archive = "ppm_archive"
+        self._week_start = 0
         self._db_name = "ppm.db"
         if not os.path.isfile(self._db_name):
             open(self._db_name, "w", encoding="utf-8").close()
 
         self.util.connect_db(self._db_name)
+        self.create_tables()
         self._credentials = self.get_credentials()
         self._dates = self.util.set_dates()
 
     def __del__(self):
         self.util.disconnect_db()
 
-    def export(self, _date):
+    def export(self, _date, _refresh=False):
         """Export PPM timesheets
 
         Args:
             _date (date): run date
+            _refresh (bool): export every week even when already ingested
+
+        Returns:
+            bool: True when every week was exported
         """
         self._dates = self.util.set_dates(_date)
         if self._credentials is not None:
-            self.cleanup_downloads(self._path_downloads, self._file_name)
+            weeks = self.plan_weeks(_refresh)
+            if not weeks:
+                print("All PPM timesheet weeks already ingested")
+                return True
+
+            started = datetime.now()
+            self.cleanup_downloads(self._path_downloads, self._file_name, self._path_archive)
             self.selenium_run(
                 self._credentials["url"],
-                "tsDate"
+                "tsDate",
+                weeks
             )
             self.save_db(self._db_name, self._path_downloads, self._file_name)
-        else:
-            print("No ppm.db credentials found")
+
+            # Weeks still planned did not download, open weeks loaded by this export count
+            missing = self.plan_weeks(_since=started)
+            if missing:
+                print(
+                    "PPM timesheet weeks not downloaded: "
+                    + ", ".join(week.strftime("%Y-%m-%d") for week in missing)
+                )
+                return False
+            return True
+
+        print("No ppm.db credentials found")
+        return False
 
 
     @staticmethod
-    def cleanup_downloads(_path_downloads, _file_name):
-        """Removes files in your downloads folder that match the PPM file name
+    def cleanup_downloads(_path_downloads, _file_name, _path_archive):
+        """Moves files in your downloads folder that match the PPM file name to the archive
 
         Args:
             _path_downloads (str): path to Downloads folder
             _file_name (str): file name to match
+            _path_archive (str): path to archive folder
         """
         all_files = glob.glob(os.path.join(_path_downloads, _file_name))
         for file in all_files:
-            os.remove(file)
+            PPM.archive_file(file, _path_archive, PPM.hash_file(file))
+
+    @staticmethod
+    def hash_file(_file):
+        """Hash the contents of a file
+
+        Args:
+            _file (str): path to file
+
+        Returns:
+            str: sha256 hex digest
+        """
+        file_hash = hashlib.sha256()
+        with open(_file, "rb") as file:
+            for chunk in iter(lambda: file.read(65536), b""):
+                file_hash.update(chunk)
+        return file_hash.hexdigest()
+
+    @staticmethod
+    def archive_file(_file, _path_archive, _hash):
+        """Move a processed file into the archive folder
+
+        Args:
+            _file (str): path to file
+            _path_archive (str): path to archive folder
+            _hash (str): content hash of the file
+
+        Returns:
+            str: path to archived file
+        """
+        os.makedirs(_path_archive, exist_ok=True)
+        archive = os.path.join(_path_archive, f"{_hash[:12]}_{os.path.basename(_file)}")
+        shutil.move(_file, archive)
+        return archive
+
+    def create_tables(self):
+        """Create the timesheet tables, adding the row key to tables from older versions
+        """
+        self.util.db_cur.execute(
+            """CREATE TABLE IF NOT EXISTS timesheet (
+                date TEXT,
+                hours REAL,
+                description TEXT,
+                project TEXT,
+                task TEXT,
+                total_hours REAL
+            )"""
+        )
+        added = self.util.add_columns("timesheet", {"task": "TEXT", "total_hours": "REAL"})
+
+        # Parse total rows saved by older versions once
+        if "total_hours" in added:
+            self.util.db_cur.execute(
+                """UPDATE timesheet
+                    SET total_hours = CAST(
+                        SUBSTR(description, INSTR(description, 'TOTAL HOURS: ') + 13, 20) AS REAL
+                    )
+                    WHERE INSTR(description, 'TOTAL HOURS: ') > 0"""
+            )
+
+        # Create index over timesheet dates if it doesn't exist
+        self.util.db_cur.execute(
+            """CREATE INDEX IF NOT EXISTS timesheet_date_index ON timesheet (date)"""
+        )
+
+        # Natural key for upserts, rows from older versions have a null task
+        self.util.db_cur.execute(
+            """CREATE UNIQUE INDEX IF NOT EXISTS timesheet_key_index
+                ON timesheet (project, task, date)"""
+        )
+
+        # Track ingested files by content hash
+        self.util.db_cur.execute(
+            """CREATE TABLE IF NOT EXISTS ingested_files (
+                hash TEXT PRIMARY KEY,
+                file_name TEXT,
+                archive TEXT,
+                ingested_at TEXT
+            )"""
+        )
+
+        # Timesheet weeks covered by an ingested file
+        self.util.db_cur.execute(
+            """CREATE TABLE IF NOT EXISTS timesheet_weeks (
+                week_start TEXT PRIMARY KEY,
+                file_hash TEXT,
+                ingested_at TEXT
+            )"""
+        )
+
+        self.util.commit_db()
 
     def get_credentials(self):
         """Get Credentials from your sqlite db credentials table
@@ -96,12 +217,51 @@ class PPM:
                 "url":creds[2]
             }
 
-    def selenium_run(self, _url, _page_parm):
+    def plan_weeks(self, _refresh=False, _since=None):
+        """Plan the timesheet weeks overlapping the period that still need exporting
+
+        A week is skipped when it was ingested after it closed. Weeks never ingested,
+        or ingested while still open, are exported.
+
+        Args:
+            _refresh (bool): plan every week even when already ingested
+            _since (datetime): also skip weeks ingested since this time, even while open
+
+        Returns:
+            list: first day of each week to export
+        """
+        # Learn which day timesheet weeks start on from the last ingested week
+        self.util.db_cur.execute("SELECT week_start FROM timesheet_weeks ORDER BY ingested_at DESC LIMIT 1")
+        last_week = self.util.db_cur.fetchone()
+        if last_week is not None:
+            self._week_start = datetime.fromisoformat(last_week[0]).weekday()
+
+        week = self._dates["fom"] - timedelta(days=(self._dates["fom"].weekday() - self._week_start) % 7)
+
+        weeks = []
+        while week <= self._dates["eom"]:
+            self.util.db_cur.execute(
+                "SELECT ingested_at FROM timesheet_weeks WHERE week_start = ?",
+                (week.isoformat(),)
+            )
+            ingested = self.util.db_cur.fetchone()
+            if (
+                _refresh or
+                ingested is None or
+                datetime.fromisoformat(ingested[0]) < min(week + timedelta(days=7), _since or datetime.max)
+            ):
+                weeks.append(week)
+            week += timedelta(days=7)
+
+        return weeks
+
+    def selenium_run(self, _url, _page_parm, _weeks):
         """Selenium - Run browser automation
 
         Args:
             _url (str): PPM url
             _page_parm (str): PPM url date parm (typically tsDate)
+            _weeks (list): a date in each week to export
         """
         # Define chrome options
         options = webdriver.ChromeOptions()
@@ -124,12 +284,12 @@ class PPM:
         # Login
         self.selenium_login(selenium_driver, selenium_wait)
 
-        # Export 6 weeks
-        for week_num in range(6):
+        # Export planned weeks
+        for week in _weeks:
             self.selenium_export_page(
                 selenium_driver,
                 selenium_wait,
-                self._dates["fom"] + timedelta(days=(week_num*7)),
+                week,
                 _url + "?" + _page_parm
             )
 
@@ -191,9 +351,126 @@ class PPM:
         options_ribbon_export.click()
         time.sleep(3)
 
+    @staticmethod
+    def parse_workbook(_file, _date):
+        """Parse an exported timesheet xlsx with a streaming read-only reader
+
+        Runs in a worker process so must not touch the database.
+
+        Args:
+            _file (str): path to xlsx file
+            _date (datetime): run date used to work out the year of each day column
+
+        Returns:
+            tuple: (list of dates in the week, list of timesheet rows keyed by project, task and date)
+        """
+        workbook = load_workbook(_file, read_only=True, data_only=True)
+        rows = workbook.active.iter_rows(values_only=True)
+        header = next(rows, ())
+
+        # Columns not loaded into the timesheet
+        skip_columns = {
+            "Process Status",
+            "WBS",
+            "Work",
+            "Remaining Work",
+            "Start",
+            "Finish",
+            "% Work Complete",
+            "Time Type",
+            "Project Name",
+            "Task Name/Description"
+        }
+        project_col = header.index("Project Name")
+        description_col = header.index("Task Name/Description")
+
+        # Get dates for each day column
+        days = []
+        for col, day in enumerate(header):
+            if day is None or day in skip_columns:
+                continue
+
+            ppm_date = datetime.strptime(day[4:] + "/" + _date.strftime("%Y"), "%m/%d/%Y")
+
+            # Weeks that cross the new year belong to the previous or next year
+            if ppm_date.month - _date.month > 6:
+                ppm_date = ppm_date.replace(year=ppm_date.year - 1)
+            elif _date.month - ppm_date.month > 6:
+                ppm_date = ppm_date.replace(year=ppm_date.year + 1)
+
+            days.append((col, ppm_date))
+
+        timesheet = {}
+        for row in rows:
+            for col, ppm_date in days:
+                # Skip rows not worked
+                if row[col] is None or str(row[col]) == "0":
+                    continue
+
+                # Duration
+                hours = float(str(row[col]).replace("h",""))
+
+                # Customer
+                project = row[project_col] if row[project_col] is not None else "0"
+
+                # Description
+                description = row[description_col] if row[description_col] is not None else "0"
+
+                # Task
+                task = description
+
+                # Total hours, only on the total row
+                total_hours = None
+
+                # Format Total Row
+                if project == "Total work":
+                    project = "*NOTE*"
+                    description = f"PPM TOTAL HOURS: {str(row[col]).replace('h','')}"
+                    task = "Total work"
+                    total_hours = hours
+                    hours = 0
+
+                # Lines for the same task on a day (e.g. different time types) are summed
+                key = (project, task, ppm_date)
+                if key in timesheet:
+                    hours += timesheet[key][1]
+
+                timesheet[key] = (ppm_date, hours, description, project, task, total_hours)
+
+        workbook.close()
+
+        return [ppm_date for _col, ppm_date in days], list(timesheet.values())
+
+    def remove_rows(self, _days, _seen):
+        """Remove rows in the days a workbook covers that are no longer on it,
+        including from the archives when the days were archived
+
+        Args:
+            _days (list): days the workbook covers
+            _seen (set): (project, task, date) on the workbook
+        """
+        retention = Retention(self.util, "timesheet")
+        retention.attach(min(_days), max(_days))
+        try:
+            for schema in retention.schemas():
+                self.util.db_cur.execute(
+                    f"SELECT rowid, project, task, date FROM {schema}.timesheet WHERE date BETWEEN ? and ?",
+                    (min(_days), max(_days))
+                )
+                removed = [
+                    (row[0],) for row in self.util.db_cur.fetchall() if tuple(row[1:]) not in _seen
+                ]
+                self.util.db_cur.executemany(f"DELETE FROM {schema}.timesheet WHERE rowid = ?", removed)
+        finally:
+            retention.detach()
+
     def save_db(self, _db_name, _path_downloads, _file_name):
         """Save exported xlsx files to sqlite db table timesheet
 
+        Each file is hashed and skipped when the same content was already ingested,
+        new files are parsed in a process pool and moved to the archive folder once saved.
+        Rows are upserted on project, task and date so only changed rows are written.
+
         Args:
             _db_name (str): sqlite database name
             _path_downloads (str): path to Downloads folder
@@ -201,78 +478,73 @@ class PPM:
         """
         self.util.connect_db(_db_name)
 
-        # Load files into database
-        self.util.db_cur.execute(
-            """CREATE TABLE IF NOT EXISTS timesheet (
-                date TEXT,
-                hours REAL,
-                description TEXT,
-                project TEXT
-            )"""
-        )
-
-        # Create index over timesheet dates if it doesn't exist
-        self.util.db_cur.execute(
-            """CREATE INDEX IF NOT EXISTS timesheet_date_index ON timesheet (date)"""
-        )
-
-        self.util.db_cur.execute(
-            "DELETE FROM timesheet WHERE date BETWEEN ? and ?",
-            (self._dates["fom"], self._dates["eom"])
-        )
+        # Oldest first so a newer export of the same week wins
+        all_files = sorted(glob.glob(os.path.join(_path_downloads, _file_name)), key=os.path.getmtime)
 
-        all_files = glob.glob(os.path.join(_path_downloads, _file_name))
+        new_files = {}
         for file in all_files:
-            df_ppm = pd.read_excel(file)
-            df_ppm = df_ppm.drop(columns=[
-                "Unnamed: 0",
-                "Process Status",
-                "WBS",
-                "Work",
-                "Remaining Work",
-                "Start",
-                "Finish",
-                "% Work Complete",
-                "Time Type"
-            ])
-            df_ppm = df_ppm.fillna("0")
-
-            for day in df_ppm.columns[2:]:
-                # Get date
-                ppm_date = datetime.strptime(
-                    day[4:] + "/" + self._dates["fom"].strftime("%Y"), "%m/%d/%Y"
-                )
-
-                for _index, row in df_ppm.iterrows():
-                    # Skip rows not worked
-                    if row[day] == "0":
-                        continue
+            file_hash = self.hash_file(file)
+            self.util.db_cur.execute("SELECT 1 FROM ingested_files WHERE hash = ?", (file_hash,))
+            if self.util.db_cur.fetchone() is not None or file_hash in new_files.values():
+                print(f"Already ingested {os.path.basename(file)}")
+                self.archive_file(file, self._path_archive, file_hash)
 
-                    # Skip dates outside range
-                    if ppm_date < self._dates["fom"] or ppm_date > self._dates["eom"]:
-                        continue
+                # Unchanged since it was loaded, so the week is now as current as this export
+                self.util.db_cur.execute(
+                    "UPDATE timesheet_weeks SET ingested_at = ? WHERE file_hash = ?",
+                    (datetime.now().isoformat(), file_hash)
+                )
+            else:
+                new_files[file] = file_hash
 
-                    # Duration
-                    hours = float(row[day].replace("h",""))
+        if len(new_files) > 1:
+            with ProcessPoolExecutor(max_workers=min(len(new_files), os.cpu_count() or 1)) as pool:
+                workbooks = list(pool.map(self.parse_workbook, new_files, repeat(self._dates["fom"])))
+        else:
+            workbooks = [self.parse_workbook(file, self._dates["fom"]) for file in new_files]
+
+        for (file, file_hash), (days, timesheet) in zip(new_files.items(), workbooks):
+            # SQL
+            self.util.db_cur.executemany(
+                """INSERT INTO timesheet (date, hours, description, project, task, total_hours)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                    ON CONFLICT (project, task, date) DO UPDATE SET
+                        hours = excluded.hours,
+                        description = excluded.description,
+                        total_hours = excluded.total_hours
+                    WHERE hours IS NOT excluded.hours
+                        OR description IS NOT excluded.description
+                        OR total_hours IS NOT excluded.total_hours""",
+                timesheet
+            )
 
-                    # Customer
-                    project = row["Project Name"]
+            # Remove rows no longer on the week the file covers
+            if days:
+                self.remove_rows(days, {(row[3], row[4], str(row[0])) for row in timesheet})
 
-                    # Description
-                    description = row["Task Name/Description"]
+            self.util.db_cur.execute(
+                "INSERT INTO ingested_files VALUES (?, ?, ?, ?)",
+                (file_hash, os.path.basename(file), None, datetime.now().isoformat())
+            )
 
-                    # Format Total Row
-                    if row["Project Name"] == "Total work":
-                        project = "*NOTE*"
-                        description = f"PPM TOTAL HOURS: {row[day].replace('h','')}"
-                        hours = 0
+            # Record the week as covered for the week planner
+            if days:
+                self.util.db_cur.execute(
+                    """INSERT INTO timesheet_weeks VALUES (?, ?, ?)
+                        ON CONFLICT (week_start) DO UPDATE SET
+                            file_hash = excluded.file_hash,
+                            ingested_at = excluded.ingested_at""",
+                    (min(days).isoformat(), file_hash, datetime.now().isoformat())
+                )
 
-                    # SQL
-                    self.util.db_cur.execute(
-                        "INSERT INTO timesheet VALUES (?, ?, ?, ?)",
-                        (ppm_date, hours, description, project)
-                    )
+        self.util.commit_db()
 
-            os.remove(file)
+        # Archive only after the rows are committed so a crash never loses a file
+        for file, file_hash in new_files.items():
+            archive = self.archive_file(file, self._path_archive, file_hash)
+            self.util.db_cur.execute(
+                "UPDATE ingested_files SET archive = ? WHERE hash = ?",
+                (archive, file_hash)
+            )
 
         self.util.commit_db()
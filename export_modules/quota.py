@@ -0,0 +1,130 @@
+"""Invoice Processor Export Module:
+    Pacing Google API requests under the per-user and per-project quota
+"""
+
+import random
+import sqlite3
+import threading
+import time
+from googleapiclient.errors import HttpError
+
+class QuotaManager:
+    """Google API quota manager class:
+        - Token bucket stored in sqlite so it is shared across threads and processes
+        - Exponential backoff with jitter on rate limit errors
+        - Request accounting for the run statistics
+    """
+    # Error reasons Google returns with 403 when a rate limit is hit
+    RATE_LIMIT_REASONS = ("rateLimitExceeded", "userRateLimitExceeded", "quotaExceeded")
+
+    def __init__(self, _db_name="quota.db", _rate=5.0, _capacity=10, _retries=6):
+        self._db_name = _db_name
+        self._rate = _rate
+        self._capacity = _capacity
+        self._retries = _retries
+        self._lock = threading.Lock()
+        self.stats = {
+            "requests": 0,
+            "retries": 0,
+            "throttled_seconds": 0.0
+        }
+
+        db_conn = sqlite3.connect(self._db_name, timeout=30)
+        db_conn.execute(
+            """CREATE TABLE IF NOT EXISTS token_bucket (
+                id INTEGER PRIMARY KEY CHECK (id = 1),
+                tokens REAL,
+                updated_at REAL
+            )"""
+        )
+        db_conn.execute(
+            "INSERT OR IGNORE INTO token_bucket VALUES (1, ?, ?)",
+            (self._capacity, time.time())
+        )
+        db_conn.commit()
+        db_conn.close()
+
+    def acquire(self):
+        """Take a token from the shared bucket, waiting until one is available
+        """
+        # Autocommit so BEGIN IMMEDIATE takes the write lock before reading the bucket
+        db_conn = sqlite3.connect(self._db_name, timeout=30, isolation_level=None)
+        try:
+            while True:
+                db_conn.execute("BEGIN IMMEDIATE")
+                tokens, updated_at = db_conn.execute(
+                    "SELECT tokens, updated_at FROM token_bucket WHERE id = 1"
+                ).fetchone()
+
+                # Refill for the time since the last request
+                now = time.time()
+                tokens = min(self._capacity, tokens + (now - updated_at) * self._rate)
+
+                if tokens >= 1:
+                    db_conn.execute(
+                        "UPDATE token_bucket SET tokens = ?, updated_at = ? WHERE id = 1",
+                        (tokens - 1, now)
+                    )
+                    db_conn.execute("COMMIT")
+                    return
+
+                db_conn.execute("COMMIT")
+                wait = (1 - tokens) / self._rate
+                self.count("throttled_seconds", wait)
+                time.sleep(wait)
+        finally:
+            db_conn.close()
+
+    def execute(self, _request):
+        """Execute a Google API request within the quota, retrying when rate limited
+
+        Args:
+            _request (object HttpRequest): Google API request
+
+        Returns:
+            dict: API response
+        """
+        for attempt in range(self._retries + 1):
+            self.acquire()
+            self.count("requests")
+            try:
+                return _request.execute()
+            except HttpError as error:
+                if not self.is_rate_limited(error) or attempt == self._retries:
+                    raise
+
+                # Exponential backoff with full jitter
+                delay = random.uniform(0, min(64, 2 ** attempt))
+                print(f"Rate limited by Google, retrying in {delay:.1f}s")
+                self.count("retries")
+                self.count("throttled_seconds", delay)
+                time.sleep(delay)
+
+        return None
+
+    def is_rate_limited(self, _error):
+        """Check if a Google API error is a rate limit error
+
+        Args:
+            _error (HttpError): Google API error
+
+        Returns:
+            bool: True when the request should be retried
+        """
+        if _error.resp.status == 429:
+            return True
+
+        content = _error.content.decode("utf-8", "replace") if _error.content else ""
+        return _error.resp.status == 403 and any(
+            reason in content for reason in self.RATE_LIMIT_REASONS
+        )
+
+    def count(self, _stat, _amount=1):
+        """Add to a run statistic
+
+        Args:
+            _stat (str): statistic name
+            _amount (float): amount to add
+        """
+        with self._lock:
+            self.stats[_stat] += _amount
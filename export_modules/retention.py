@@ -0,0 +1,247 @@
+"""Invoice Processor Export Module:
+    Archiving closed periods into per-year databases
+"""
+
+from datetime import date, timedelta
+import csv
+import gzip
+import os
+import re
+
+# Date column and natural key of each table that can be archived
+TABLES = {
+    "calendar": ("start", ("calendar", "event_id", "instance_start")),
+    "timesheet": ("date", ("project", "task", "date"))
+}
+
+class Retention:
+    """Retention class:
+        - Moves rows before a cutoff into per-year archive databases
+        - Optional gzip csv export of each archive
+        - Vacuums and analyzes the hot database
+        - Attaches archives for report queries that need them
+    """
+    def __init__(self, _util, _table):
+        self.util = _util
+        self._table = _table
+        self._date_column, self._key_columns = TABLES[_table]
+        self._attached = []
+
+    @staticmethod
+    def cutoff(_keep_months, _date=None):
+        """First day of the oldest month kept in the hot database
+
+        Args:
+            _keep_months (int): closed months to keep in addition to the current month
+            _date (date): date to count back from
+
+        Returns:
+            date: first day of month
+        """
+        cutoff = (_date or date.today()).replace(day=1)
+        for _month in range(_keep_months):
+            cutoff = (cutoff - timedelta(days=1)).replace(day=1)
+        return cutoff
+
+    def archive_name(self, _year):
+        """Archive database name for a year
+
+        Args:
+            _year (int): year
+
+        Returns:
+            str: path to archive database
+        """
+        stem = os.path.splitext(self.util.db_name)[0]
+        return f"{stem}_archive_{_year}.db"
+
+    def get_cutoff(self):
+        """Get the cutoff previously archived for this table
+
+        Returns:
+            str: cutoff date (YYYY-MM-DD) or None when nothing has been archived
+        """
+        self.util.db_cur.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'retention'"
+        )
+        if self.util.db_cur.fetchone() is None:
+            return None
+
+        self.util.db_cur.execute(
+            "SELECT cutoff FROM retention WHERE table_name = ?",
+            (self._table,)
+        )
+        cutoff = self.util.db_cur.fetchone()
+        return cutoff[0] if cutoff else None
+
+    def archive(self, _cutoff, _compress=False):
+        """Move rows dated before the cutoff into per-year archive databases
+
+        Args:
+            _cutoff (date): rows before this date are archived
+            _compress (bool): also write a gzip csv of each archive
+        """
+        cutoff = _cutoff.isoformat()
+
+        self.util.db_cur.execute(
+            """CREATE TABLE IF NOT EXISTS retention (
+                table_name TEXT PRIMARY KEY,
+                cutoff TEXT
+            )"""
+        )
+
+        self.util.db_cur.execute(
+            f"""SELECT DISTINCT SUBSTR({self._date_column},1,4) FROM {self._table}
+                WHERE {self._date_column} < ?""",
+            (cutoff,)
+        )
+        years = sorted(int(year[0]) for year in self.util.db_cur.fetchall())
+
+        columns = ", ".join(self.util.get_columns(self._table))
+
+        for year in years:
+            # Rows in this year before the cutoff
+            start = f"{year}-01-01"
+            end = min(cutoff, f"{year + 1}-01-01")
+
+            self.util.commit_db()
+            self.util.db_cur.execute("ATTACH DATABASE ? AS archive", (self.archive_name(year),))
+            self.create_archive_table()
+
+            # Replace on the natural key so a re-exported period is not archived twice
+            self.util.db_cur.execute(
+                f"""INSERT OR REPLACE INTO archive.{self._table} ({columns})
+                    SELECT {columns} FROM main.{self._table}
+                    WHERE {self._date_column} >= ? AND {self._date_column} < ?""",
+                (start, end)
+            )
+            moved = self.util.db_cur.rowcount
+            self.util.db_cur.execute(
+                f"""DELETE FROM main.{self._table}
+                    WHERE {self._date_column} >= ? AND {self._date_column} < ?""",
+                (start, end)
+            )
+            self.util.commit_db()
+
+            if _compress:
+                self.export_archive(year)
+
+            self.util.db_cur.execute("DETACH DATABASE archive")
+            print(f"Archived {moved} {self._table} rows to {self.archive_name(year)}")
+
+        # Cutoff only moves forward
+        self.util.db_cur.execute(
+            """INSERT INTO retention VALUES (?, ?)
+                ON CONFLICT (table_name) DO UPDATE SET cutoff = MAX(cutoff, excluded.cutoff)""",
+            (self._table, cutoff)
+        )
+        self.util.commit_db()
+
+        # Reclaim space and refresh query planner statistics
+        self.util.db_cur.execute("VACUUM")
+        self.util.db_cur.execute("ANALYZE")
+
+    def create_archive_table(self):
+        """Create the table and indexes in the attached archive matching the hot table
+        """
+        self.util.db_cur.execute(
+            f"""CREATE TABLE IF NOT EXISTS archive.{self._table} AS
+                SELECT * FROM main.{self._table} WHERE 0"""
+        )
+
+        # Columns added to the hot table since the archive was created
+        self.util.add_columns(self._table, self.util.get_columns(self._table), "archive")
+
+        self.util.db_cur.execute(
+            "SELECT sql FROM main.sqlite_master WHERE type = 'index' AND tbl_name = ? AND sql IS NOT NULL",
+            (self._table,)
+        )
+        for index in self.util.db_cur.fetchall():
+            self.util.db_cur.execute(
+                re.sub(r"INDEX (IF NOT EXISTS )?(\w+)", r"INDEX IF NOT EXISTS archive.\2", index[0])
+            )
+
+    def export_archive(self, _year):
+        """Write the attached archive table to a gzip csv
+
+        Args:
+            _year (int): archive year
+        """
+        self.util.db_cur.execute(f"SELECT * FROM archive.{self._table}")
+        with gzip.open(
+            os.path.splitext(self.archive_name(_year))[0] + f"_{self._table}.csv.gz",
+            "wt", encoding="UTF-8", newline=""
+        ) as f:
+            writer = csv.writer(f)
+            writer.writerow([column[0] for column in self.util.db_cur.description])
+            for row in self.util.db_cur:
+                writer.writerow(row)
+
+    def attach(self, _start, _end):
+        """Attach the archives a period needs and shadow the table with a temp view over all of them
+
+        Args:
+            _start (str|datetime): start of period
+            _end (str|datetime): end of period
+        """
+        cutoff = self.get_cutoff()
+        start = str(_start)[:10]
+        if cutoff is None or start >= cutoff:
+            return
+
+        # Attach needs no open transaction
+        self.util.commit_db()
+
+        end_year = int(min(str(_end)[:10], cutoff)[:4])
+        for year in range(int(start[:4]), end_year + 1):
+            if os.path.isfile(self.archive_name(year)):
+                schema = f"archive_{year}"
+                self.util.db_cur.execute(f"ATTACH DATABASE ? AS {schema}", (self.archive_name(year),))
+                self._attached.append(schema)
+
+        if not self._attached:
+            return
+
+        hot_columns = self.util.get_columns(self._table)
+        selects = [f"SELECT {', '.join(hot_columns)} FROM main.{self._table}"]
+        for schema in self._attached:
+            archive_columns = self.util.get_columns(self._table, schema)
+            columns = ", ".join(
+                column if column in archive_columns else f"NULL AS {column}" for column in hot_columns
+            )
+            # Skip archived rows that were exported again into the hot table, rows from
+            # older versions have null keys so they also need the same date
+            key_columns = [column for column in self._key_columns if column in archive_columns]
+            key_match = " AND ".join(f"h.{column} IS a.{column}" for column in key_columns)
+            key_match += (
+                f" AND (NOT ({' OR '.join(f'a.{column} IS NULL' for column in key_columns)})"
+                f" OR h.{self._date_column} IS a.{self._date_column})"
+            )
+            selects.append(
+                f"""SELECT {columns} FROM {schema}.{self._table} a
+                    WHERE NOT EXISTS (SELECT 1 FROM main.{self._table} h WHERE {key_match})"""
+            )
+
+        self.util.db_cur.execute(
+            f"CREATE TEMP VIEW {self._table} AS {' UNION ALL '.join(selects)}"
+        )
+
+    def schemas(self):
+        """Schemas holding the table while archives are attached
+
+        Returns:
+            list: main followed by the attached archive schemas
+        """
+        return ["main"] + self._attached
+
+    def detach(self):
+        """Drop the temp view and detach archives attached by attach()
+        """
+        if not self._attached:
+            return
+
+        self.util.commit_db()
+        self.util.db_cur.execute(f"DROP VIEW IF EXISTS temp.{self._table}")
+        for schema in self._attached:
+            self.util.db_cur.execute(f"DETACH DATABASE {schema}")
+        self._attached = []
@@ -1,6 +1,7 @@
 """Invoice Processor Utility Module
 """
 from datetime import date, datetime
+from pathlib import Path
 import calendar
 import sqlite3
 
@@ -13,6 +14,7 @@ class ExportUtil:
     def __init__(self):
         self.db_conn = None
         self.db_cur = None
+        self.db_name = None
         self.set_dates(date.today())
 
     def set_dates(self, _date=date.today()):
@@ -55,18 +57,57 @@ class ExportUtil:
         """
         return self._dates
 
-    def connect_db(self, _db):
+    def connect_db(self, _db, _read_only=False):
         """Connect to Database
 
         Args:
             _db (str): sqlite database name
+            _read_only (bool): open read-only so the connection can be used from any thread
         """
         if hasattr(self, "db_conn"):
-            self.db_conn = sqlite3.connect(_db)
+            if _read_only:
+                self.db_conn = sqlite3.connect(
+                    Path(_db).absolute().as_uri() + "?mode=ro", uri=True, check_same_thread=False
+                )
+            else:
+                self.db_conn = sqlite3.connect(_db)
+            self.db_name = _db
 
         if hasattr(self, "db_cur"):
             self.db_cur = self.db_conn.cursor()
 
+    def get_columns(self, _table, _schema="main"):
+        """Get the column names and types of a table
+
+        Args:
+            _table (str): table name
+            _schema (str): database schema name
+
+        Returns:
+            dict: column name and type
+        """
+        self.db_cur.execute(f"PRAGMA {_schema}.table_info({_table})")
+        return {column[1]: column[2] for column in self.db_cur.fetchall()}
+
+    def add_columns(self, _table, _columns, _schema="main"):
+        """Add columns missing from a table created by an older version
+
+        Args:
+            _table (str): table name
+            _columns (dict): column name and type
+            _schema (str): database schema name
+
+        Returns:
+            list: columns added
+        """
+        existing = self.get_columns(_table, _schema)
+        added = []
+        for column, column_type in _columns.items():
+            if column not in existing:
+                self.db_cur.execute(f"ALTER TABLE {_schema}.{_table} ADD COLUMN {column} {column_type}")
+                added.append(column)
+        return added
+
     def commit_db(self):
         """Commit changes to Database
         """
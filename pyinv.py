@@ -3,436 +3,421 @@ Automated time extraction from Microsoft PPM and Google Calendar.
 """
 
 from datetime import datetime, timedelta
-import csv
-import os
+import argparse
+import sys
+from export_modules.backfill import Backfill
 from export_modules.gcal import GCal
 from export_modules.ppm import PPM
+from export_modules.retention import Retention
+from report_modules.engine import DETAIL_QUERIES, ReportEngine
+from report_modules.report import Report, Summary
+from report_modules.server import Server
+from report_modules.suggest import Suggest
+from report_modules.writers import ReportWriters, WRITERS
+
+def main():
+    """Parse command line and run the requested command, invoice when none is given
+    """
+    # Options shared by the commands that export or report
+    gcal_options = argparse.ArgumentParser(add_help=False)
+    gcal_options.add_argument(
+        "--expand-recurring", action="store_true",
+        help="expand recurring Google Calendar events locally instead of on the server"
+    )
+    ppm_options = argparse.ArgumentParser(add_help=False)
+    ppm_options.add_argument(
+        "--refresh-ppm", action="store_true",
+        help="export every PPM timesheet week even when already ingested"
+    )
+    report_options = argparse.ArgumentParser(add_help=False)
+    report_options.add_argument(
+        "--format", default="csv",
+        help=f"comma separated report formats ({', '.join(WRITERS)})"
+    )
+    report_options.add_argument(
+        "--no-open", action="store_true",
+        help="do not open the report when finished"
+    )
+
+    parser = argparse.ArgumentParser(description="Invoice Processor")
+    subparsers = parser.add_subparsers(dest="command")
 
-# Get last month's date
-last_month = datetime.now().replace(day=1) - timedelta(days=1)
-
-# Prompts before running exports
-run_date = input("Enter month you want to invoice (YYYY-MM): ") or last_month.strftime("%Y-%m")
-export_gcal = input("Export Google Calendar? (Y/N): ") or "N"
-export_ppm = input("Export PPM? (Y/N): ") or "N"
-
-# Setup new export objects
-gcal = GCal()
-ppm = PPM()
-
-# Run exports
-run_date = datetime.strptime(run_date + "-01", "%Y-%m-%d")
-
-if export_gcal == "Y":
-    gcal.export(run_date)
-    print("Exported Google Calendar")
-else:
-    gcal.util.set_dates(run_date)
-
-if export_ppm == "Y":
-    ppm.export(run_date)
-    print("Exported PPM")
-else:
-    ppm.util.set_dates(run_date)
-
-# Create xref and ignore tables if they don't exist
-gcal.util.db_cur.execute(
-    """CREATE TABLE IF NOT EXISTS project_xref (
-        calendar TEXT,
-        gcal_title REAL,
-        inv_title REAL
-    )"""
-)
-gcal.util.db_cur.execute(
-    """CREATE TABLE IF NOT EXISTS ignore (
-        calendar TEXT,
-        title REAL,
-        flag TEXT
-    )"""
-)
-
-# Create xref and ignore tables if they don't exist
-ppm.util.db_cur.execute(
-    """CREATE TABLE IF NOT EXISTS project_xref (
-        ppm_project TEXT,
-        inv_project TEXT
-    )"""
-)
-ppm.util.db_cur.execute(
-    """CREATE TABLE IF NOT EXISTS ignore (
-        project TEXT,
-        description TEXT,
-        flag TEXT
-    )"""
-)
-
-# Get dates from GCal export module
-gcal_dates = gcal.util.get_dates()
-
-# Get dates from PPM export module
-ppm_dates = ppm.util.get_dates()
-
-# Loop through distinct titles in gcal.db where start between fom_isoz and eom_isoz
-gcal.util.db_cur.execute(
-    """SELECT DISTINCT calendar, title FROM calendar WHERE start BETWEEN ? and ?
-        AND SUBSTR(start,11,1) = 'T'
-    """,
-    (gcal_dates["fom_isoz"], gcal_dates["eom_isoz"])
-)
-gcal_titles = gcal.util.db_cur.fetchall()
-
-print("""
-    Google Calendar Titles----------------
-
-    When PPM has a project for meetings you should ignore the Google Calendar events that match.
-    When PPM does not have a project for meetings you should enter the invoice project.
-
-    All-day calendar events will be evenly divided between PPM projects when invoiced as *GCAL on the PPM project.
-        Do NOT ignore these calendar events if you want to use this feature.
-""")
-for title in gcal_titles:
-    print(f"Calendar:  {title[0]}")
-    print(f"Title: {title[1]}")
-    # Check if title is in ignore table
-    gcal.util.db_cur.execute(
-        "SELECT title, flag FROM ignore WHERE calendar = ? AND title = ?",
-        (title[0], title[1])
+    subparsers.add_parser(
+        "invoice", parents=[gcal_options, ppm_options, report_options],
+        help="export a month and write the invoice reports (default)"
     )
-    ignore = gcal.util.db_cur.fetchone()
-    if ignore is None:
-        # Prompt user for ignore
-        ignore_prompt = input(f"Ignore {title[1]}? (Y/N): ") or "N"
 
-        # Add to ignore table
-        gcal.util.db_cur.execute(
-            "INSERT INTO ignore VALUES (?, ?, ?)",
-            (title[0], title[1], ignore_prompt)
-        )
-        gcal.util.commit_db()
+    serve_parser = subparsers.add_parser(
+        "serve", parents=[gcal_options], help="sync on a schedule and serve reports over HTTP"
+    )
+    serve_parser.add_argument("--host", default="127.0.0.1", help="address to listen on")
+    serve_parser.add_argument("--port", type=int, default=8765, help="port to listen on")
+    serve_parser.add_argument("--interval", type=int, default=60, help="minutes between syncs")
+    serve_parser.add_argument("--months", type=int, default=2, help="recent months to sync")
+    serve_parser.add_argument("--no-ppm", action="store_true", help="only sync Google Calendar")
+
+    archive_parser = subparsers.add_parser("archive", help="move closed months into per-year archives")
+    archive_parser.add_argument("--keep-months", type=int, default=12, help="closed months to keep")
+    archive_parser.add_argument("--compress", action="store_true", help="also export archives to csv.gz")
+
+    backfill_parser = subparsers.add_parser(
+        "backfill", parents=[gcal_options, ppm_options],
+        help="export a range of past months, resuming where it stopped"
+    )
+    backfill_parser.add_argument("--start", required=True, help="first month (YYYY-MM)")
+    backfill_parser.add_argument("--end", default=None, help="last month (YYYY-MM), defaults to last month")
+    backfill_parser.add_argument("--sources", default="gcal,ppm", help="comma separated sources (gcal, ppm)")
+    backfill_parser.add_argument("--workers", type=int, default=4, help="Google Calendar months exported at once")
+    backfill_parser.add_argument("--restart", action="store_true", help="export months already done again")
+
+    # Invoice when no command is given, so pyinv.py --format xlsx still works
+    argv = sys.argv[1:]
+    if not argv or argv[0] not in list(subparsers.choices) + ["-h", "--help"]:
+        argv = ["invoice"] + argv
+    args = parser.parse_args(argv)
+
+    if args.command == "serve":
+        serve(args)
+    elif args.command == "archive":
+        archive(args)
+    elif args.command == "backfill":
+        backfill(args)
     else:
-        print(f"Ignored (Y/N): {ignore[1]}")
+        invoice(args)
+
+def serve(_args):
+    """Keep exports warm and serve the detail and summary from the live databases
+
+    Args:
+        _args (Namespace): serve command line arguments
+    """
+    gcal = GCal(_args.expand_recurring)
+    ppm = PPM()
+
+    server = Server(gcal, ppm, _args.interval, _args.months, not _args.no_ppm)
+    server.run(_args.host, _args.port)
+
+    # Close the database connections
+    gcal.util.disconnect_db()
+    ppm.util.disconnect_db()
+
+def archive(_args):
+    """Move closed months out of the hot databases
+
+    Args:
+        _args (Namespace): archive command line arguments
+    """
+    gcal = GCal()
+    ppm = PPM()
+
+    cutoff = Retention.cutoff(max(_args.keep_months, 1))
+    print(f"Archiving before {cutoff.isoformat()}")
+    Retention(gcal.util, "calendar").archive(cutoff, _args.compress)
+    Retention(ppm.util, "timesheet").archive(cutoff, _args.compress)
+
+    # Close the database connections
+    gcal.util.disconnect_db()
+    ppm.util.disconnect_db()
+
+def backfill(_args):
+    """Export a range of past months, checkpointing each month so a rerun resumes
 
-    ignored = (
-        (ignore is None and ignore_prompt == "Y") or
-        (ignore is not None and ignore[1] == "Y")
+    Args:
+        _args (Namespace): backfill command line arguments
+    """
+    end = _args.end or (datetime.now().replace(day=1) - timedelta(days=1)).strftime("%Y-%m")
+    sources = _args.sources.split(",")
+
+    gcal = GCal(_args.expand_recurring)
+    ppm = PPM()
+
+    failed = Backfill(gcal, ppm, _args.workers, _args.expand_recurring, _args.refresh_ppm).run(
+        _args.start, end, sources, _args.restart
     )
+    for source, periods in failed.items():
+        if periods:
+            print(f"{source} months failed: {', '.join(periods)}, run backfill again to retry them")
+
+    # Close the database connections
+    gcal.util.disconnect_db()
+    ppm.util.disconnect_db()
+
+def map_projects(_unmapped, _suggest, _accept_score=0.8):
+    """Prompt for invoice projects, offering suggestions that can be accepted in bulk
+
+    Args:
+        _unmapped (list): (key, title) needing an invoice project
+        _suggest (Suggest): suggestion index, accepted projects are added to it
+        _accept_score (float): minimum similarity (0-1) for accepting a suggestion in bulk
+
+    Returns:
+        list: (key, invoice project)
+    """
+    if not _unmapped:
+        return []
+
+    suggestions = [_suggest.suggest(title) for _key, title in _unmapped]
+
+    # Offer to accept every close top suggestion at once
+    accept_all = "N"
+    if any(suggestion and suggestion[0][1] >= _accept_score for suggestion in suggestions):
+        print("Suggested invoice projects:")
+        for (_key, title), suggestion in zip(_unmapped, suggestions):
+            if suggestion and suggestion[0][1] >= _accept_score:
+                print(f"    {title} -> {suggestion[0][0]} ({suggestion[0][1]:.0%})")
+        accept_all = input("Accept all suggestions? (Y/N): ") or "N"
+
+    mapped = []
+    for (key, title), suggestion in zip(_unmapped, suggestions):
+        if accept_all == "Y" and suggestion and suggestion[0][1] >= _accept_score:
+            inv_project = suggestion[0][0]
+        else:
+            print(f"Title: {title}")
+            for number, (project, score) in enumerate(suggestion, 1):
+                print(f"    {number}) {project} ({score:.0%})")
+
+            # Prompt user for invoice project, a number picks a suggestion
+            inv_project = input("Enter invoice project: ") or title
+            if inv_project.isdigit() and 0 < int(inv_project) <= len(suggestion):
+                inv_project = suggestion[int(inv_project) - 1][0]
+
+        print(f"Invoiced as: {inv_project}")
+        _suggest.add(title, inv_project)
+        mapped.append((key, inv_project))
+
+    return mapped
+
+def invoice(_args):
+    """Run exports and build the invoice detail and summary
+
+    Args:
+        _args (Namespace): command line arguments
+    """
+    # Get last month's date
+    last_month = datetime.now().replace(day=1) - timedelta(days=1)
+
+    # Prompts before running exports
+    run_date = input("Enter month you want to invoice (YYYY-MM): ") or last_month.strftime("%Y-%m")
+    export_gcal = input("Export Google Calendar? (Y/N): ") or "N"
+    export_ppm = input("Export PPM? (Y/N): ") or "N"
+
+    # Setup new export objects
+    gcal = GCal(_args.expand_recurring)
+    ppm = PPM()
+
+    # Run exports
+    run_date = datetime.strptime(run_date + "-01", "%Y-%m-%d")
+
+    if export_gcal == "Y":
+        gcal.export(run_date)
+        print("Exported Google Calendar")
+    else:
+        gcal.util.set_dates(run_date)
 
-    # Check if title is in xref table
-    if not ignored:
+    if export_ppm == "Y":
+        ppm.export(run_date, _args.refresh_ppm)
+        print("Exported PPM")
+    else:
+        ppm.util.set_dates(run_date)
+
+    # Setup report, creates xref and ignore tables if they don't exist
+    report = Report(gcal.util, ppm.util)
+
+    # Report queries run concurrently on read-only connections
+    engine = ReportEngine(gcal.util.db_name, ppm.util.db_name)
+    titles = engine.submit(run_date, ("gcal_titles", "ppm_projects"))
+
+    # Suggest invoice projects from the titles and projects already mapped in each source
+    gcal_suggest = Suggest(report.gcal_mappings())
+    ppm_suggest = Suggest(report.ppm_mappings())
+
+    # Loop through distinct titles in gcal.db where start between fom_isoz and eom_isoz
+    gcal_titles = titles["gcal_titles"].result()
+    gcal_unmapped = []
+
+    print("""
+        Google Calendar Titles----------------
+
+        When PPM has a project for meetings you should ignore the Google Calendar events that match.
+        When PPM does not have a project for meetings you should enter the invoice project.
+
+        All-day calendar events will be evenly divided between PPM projects when invoiced as *GCAL on the PPM project.
+            Do NOT ignore these calendar events if you want to use this feature.
+    """)
+    for title in gcal_titles:
+        print(f"Calendar:  {title[0]}")
+        print(f"Title: {title[1]}")
+        # Check if title is in ignore table
         gcal.util.db_cur.execute(
-            "SELECT inv_title FROM project_xref WHERE calendar = ? AND gcal_title = ?",
+            "SELECT title, flag FROM ignore WHERE calendar = ? AND title = ?",
             (title[0], title[1])
         )
-        inv_title = gcal.util.db_cur.fetchone()
-        if inv_title is None:
-            # Prompt user for invoice project
-            inv_title = input("Enter invoice project: ") or title[1]
+        ignore = gcal.util.db_cur.fetchone()
+        if ignore is None:
+            # Prompt user for ignore
+            ignore_prompt = input(f"Ignore {title[1]}? (Y/N): ") or "N"
 
-            # Add to xref table
+            # Add to ignore table
             gcal.util.db_cur.execute(
-                "INSERT INTO project_xref VALUES (?, ?, ?)",
-                (title[0], title[1], inv_title)
+                "INSERT INTO ignore VALUES (?, ?, ?)",
+                (title[0], title[1], ignore_prompt)
             )
             gcal.util.commit_db()
         else:
-            print(f"Invoiced as: {inv_title[0]}")
-
-# Loop through distinct projects in ppm.db where date between fom and eom
-ppm.util.db_cur.execute(
-    """SELECT DISTINCT
-           project, description
-       FROM timesheet
-       WHERE date BETWEEN ? and ?
-       AND INSTR(description, 'TOTAL HOURS: ') = 0
-    """,
-    (ppm_dates["fom"], ppm_dates["eom"])
-)
-ppm_projects = ppm.util.db_cur.fetchall()
-
-print("""
-    PPM Projects----------------
-
-    PPM special feature:
-    When prompted for invoice project use *GCAL to evenly divide hours
-        for PPM projects using All-day Google Calendar events.
-    """
-)
+            print(f"Ignored (Y/N): {ignore[1]}")
 
-for project in ppm_projects:
-    print(f"Project:  {project[0]}")
-    print(f"Description: {project[1]}")
+        ignored = (
+            (ignore is None and ignore_prompt == "Y") or
+            (ignore is not None and ignore[1] == "Y")
+        )
 
-     # Check if project is in ignore table
-    ppm.util.db_cur.execute(
-        "SELECT project, description, flag FROM ignore WHERE project = ? and description = ?",
-        (project[0], project[1])
-    )
+        # Check if title is in xref table
+        if not ignored:
+            gcal.util.db_cur.execute(
+                "SELECT inv_title FROM project_xref WHERE calendar = ? AND gcal_title = ?",
+                (title[0], title[1])
+            )
+            inv_title = gcal.util.db_cur.fetchone()
+            if inv_title is None:
+                # Prompt for invoice project after all titles are reviewed
+                gcal_unmapped.append(title)
+            else:
+                print(f"Invoiced as: {inv_title[0]}")
+
+    for title, inv_title in map_projects([(title, title[1]) for title in gcal_unmapped], gcal_suggest):
+        # Add to xref table
+        gcal.util.db_cur.execute(
+            "INSERT INTO project_xref VALUES (?, ?, ?)",
+            (title[0], title[1], inv_title)
+        )
+    gcal.util.commit_db()
 
-    ignore = ppm.util.db_cur.fetchone()
-    if ignore is None:
-        # Prompt user for ignore
-        ignore_prompt = input(f"Ignore {project[1]}? (Y/N): ") or "N"
+    # Loop through distinct projects in ppm.db where date between fom and eom
+    ppm_projects = titles["ppm_projects"].result()
+    ppm_unmapped = []
 
-        # Add to ignore table
-        ppm.util.db_cur.execute(
-            "INSERT INTO ignore VALUES (?, ?, ?)",
-            (project[0], project[1], ignore_prompt)
-        )
-        ppm.util.commit_db()
-    else:
-        print(f"Ignored (Y/N): {ignore[2]}")
+    print("""
+        PPM Projects----------------
 
-    ignored = (
-        (ignore is None and ignore_prompt == "Y") or
-        (ignore is not None and ignore[1] == "Y")
+        PPM special feature:
+        When prompted for invoice project use *GCAL to evenly divide hours
+            for PPM projects using All-day Google Calendar events.
+        """
     )
 
-    # Check if project is in xref table
-    if not ignored:
+    for project in ppm_projects:
+        print(f"Project:  {project[0]}")
+        print(f"Description: {project[1]}")
+
+         # Check if project is in ignore table
         ppm.util.db_cur.execute(
-            "SELECT inv_project FROM project_xref WHERE ppm_project = ?",
-            (project[0],)
+            "SELECT project, description, flag FROM ignore WHERE project = ? and description = ?",
+            (project[0], project[1])
         )
-        inv_project = ppm.util.db_cur.fetchone()
-        if inv_project is None:
-            # Prompt user for invoice project
-            inv_project = input("Enter invoice project: ") or project[0]
 
-            # Add to xref table
+        ignore = ppm.util.db_cur.fetchone()
+        if ignore is None:
+            # Prompt user for ignore
+            ignore_prompt = input(f"Ignore {project[1]}? (Y/N): ") or "N"
+
+            # Add to ignore table
             ppm.util.db_cur.execute(
-                "INSERT INTO project_xref VALUES (?, ?)",
-                (project[0], inv_project)
+                "INSERT INTO ignore VALUES (?, ?, ?)",
+                (project[0], project[1], ignore_prompt)
             )
             ppm.util.commit_db()
         else:
-            print(f"Invoiced as: {inv_project[0]}")
-
-# Select all the calendar entries for run_date join to xref and ignore tables exclude any ignored
-gcal.util.db_cur.execute(
-    """SELECT
-           TRIM(COALESCE(px.inv_title,ca.title)) as project,
-           TRIM(ca.title) as notes,
-           SUBSTR(ca.start,1,10) as date,
-           case
-                when SUBSTR(ca.start,11,1) = 'T' then
-                    ROUND(duration/60,2)
-                else
-                    0
-           end as hours,
-           'gcal' as source
-        FROM calendar ca
-        LEFT OUTER JOIN project_xref px
-        ON ca.calendar = px.calendar AND ca.title = px.gcal_title
-        WHERE
-        ca.start BETWEEN ? and ?
-        AND (ca.calendar, ca.title) NOT IN (
-            SELECT calendar, title FROM ignore WHERE flag = 'Y'
-        )
-        AND SUBSTR(ca.start,11,1) = 'T'
-        """,
-    (gcal_dates["fom_isoz"], gcal_dates["eom_isoz"])
-)
-gcal_calendar = gcal.util.db_cur.fetchall()
-
-# Loop through hours and round up to the nearest 15 minutes saving to new list
-gcal_calendar_rounded = []
-for entry in gcal_calendar:
-    if entry[3] % 0.25 != 0:
-        entry = list(entry)
-        print(f"Rounding up {entry[1]} on {entry[2]} from {entry[3]} to {round(entry[3] + 0.25 - (entry[3] % 0.25), 2)}")
-        # Round up to nearest 15 minutes
-        entry[3] = round(entry[3] + 0.25 - (entry[3] % 0.25), 2)
-    # Save to new list
-    gcal_calendar_rounded.append(entry)
-
-# Set gcal_calendar to gcal_calendar_rounded
-gcal_calendar = gcal_calendar_rounded
-
-# Select all the timesheet entries for run_date join to xref and ignore tables exclude any ignored
-ppm.util.db_cur.execute(
-    """SELECT
-            TRIM(COALESCE(px.inv_project, ts.project)) as project,
-            TRIM(ts.description) as notes,
-            SUBSTR(ts.date,1,10) as date,
-            ts.hours as hours,
-            'ppm' as source
-        FROM timesheet ts
-        LEFT OUTER JOIN project_xref px
-        ON ts.project = px.ppm_project
-        WHERE
-        ts.date BETWEEN ? and ?
-        AND (ts.project, ts.description) NOT IN (
-            SELECT project, description FROM ignore WHERE flag = 'Y'
-        )
-        AND INSTR(ts.description, 'TOTAL HOURS: ') = 0
-        AND COALESCE(px.inv_project, ts.project) <> '*GCAL'
-    """,
-    (ppm_dates["fom"], ppm_dates["eom"])
-)
-ppm_timesheet = ppm.util.db_cur.fetchall()
-
-# Get worked hours
-ppm.util.db_cur.execute(
-    """ SELECT
-            'WORKED HOURS' as project,
-            '************' as notes,
-            SUBSTR(ts.date,1,10) as date,
-            SUBSTR(ts.description, INSTR(ts.description, 'TOTAL HOURS: ') + 13, 20) -
-                COALESCE(ih.ignored_hours, 0) as worked_hours,
-            '************' as source
-        FROM timesheet ts
-        LEFT OUTER JOIN (
-            SELECT
-                date,
-                hours as ignored_hours
-            FROM timesheet tx
-            JOIN ignore ig
-            ON tx.project = ig.project
-            AND tx.description = ig.description
-            AND ig.flag = 'Y') as ih
-        ON ts.date = ih.date
-        WHERE
-        ts.date BETWEEN ? and ?
-        AND INSTR(ts.description, 'TOTAL HOURS: ') > 0
-    """,
-    (ppm_dates["fom"], ppm_dates["eom"])
-)
-ppm_worked_hours = ppm.util.db_cur.fetchall()
-
-# Get gcal splits
-ppm.util.db_cur.execute(
-    """ SELECT
-            TRIM(COALESCE(px.inv_project, ts.project)) as project,
-            TRIM(ts.description) as notes,
-            SUBSTR(ts.date,1,10) as date,
-            ts.hours as hours,
-            'ppm' as source
-        FROM timesheet ts
-        LEFT OUTER JOIN project_xref px
-        ON ts.project = px.ppm_project
-        WHERE
-        ts.date BETWEEN ? and ?
-        AND (ts.project, ts.description) NOT IN (
-            SELECT project, description FROM ignore WHERE flag = 'Y'
-        )
-        AND COALESCE(px.inv_project, ts.project) = '*GCAL'
-    """,
-    (ppm_dates["fom"], ppm_dates["eom"])
-)
-ppm_splits = ppm.util.db_cur.fetchall()
-gcal_splits = []
-
-# Loop through gcal_ppm_splits and find matching gcal entries
-for entry in ppm_splits:
-    gcal.util.db_cur.execute(
-        """ SELECT
-                COALESCE(px.inv_title, ca.title) as title,
-                ca.title as notes
-            FROM
-                calendar ca
-                LEFT OUTER JOIN project_xref px
-                ON ca.calendar = px.calendar
-                AND ca.title = px.gcal_title
-            WHERE
-                ? between ca.start and ca.end
-                AND SUBSTR(ca.start,11,1) <> 'T'
-                AND (ca.calendar, ca.title) NOT IN (
-                    SELECT calendar, title FROM ignore WHERE flag = 'Y'
-                )
-        """,
-        (entry[2],)
-    )
-    gcal_entries = gcal.util.db_cur.fetchall()
-
-    split_hours = 0
+            print(f"Ignored (Y/N): {ignore[2]}")
 
-    # Loop through gcal_entries and add to gcal_splits
-    for gcal_entry in gcal_entries:
-        # Divide hours from entry[3] by number of gcal_entries
-        hours = entry[3] / len(gcal_entries)
-
-        # Round hours to nearest 15 minutes
-        if hours % 0.25 != 0:
-            hours = round(hours + 0.25 - (hours % 0.25), 2)
-
-        # Cap hours at ppm entry hours
-        if split_hours + hours > entry[3]:
-            hours = entry[3] - split_hours
-
-        # Add hours to split_hours
-        split_hours += hours
-
-        gcal_splits.append([gcal_entry[0], gcal_entry[1], entry[2], hours, "*gcal"])
+        ignored = (
+            (ignore is None and ignore_prompt == "Y") or
+            (ignore is not None and ignore[1] == "Y")
+        )
 
-    if len(gcal_entries) == 0:
-        print("No matching gcal entry for " + entry[1] + " on " + entry[2])
+        # Check if project is in xref table
+        if not ignored:
+            ppm.util.db_cur.execute(
+                "SELECT inv_project FROM project_xref WHERE ppm_project = ?",
+                (project[0],)
+            )
+            inv_project = ppm.util.db_cur.fetchone()
+            if inv_project is None:
+                # Prompt for invoice project after all projects are reviewed
+                if project[0] not in ppm_unmapped:
+                    ppm_unmapped.append(project[0])
+            else:
+                print(f"Invoiced as: {inv_project[0]}")
+
+    for project, inv_project in map_projects([(project, project) for project in ppm_unmapped], ppm_suggest):
+        # Add to xref table
+        ppm.util.db_cur.execute(
+            "INSERT INTO project_xref VALUES (?, ?)",
+            (project, inv_project)
+        )
+    ppm.util.commit_db()
 
-        # Add entry to gcal_splits
-        gcal_splits.append([entry[0], entry[1], entry[2], entry[3], "ppm"])
+    # Start the detail and overlap queries together now the mappings are saved
+    queries = engine.submit(run_date, DETAIL_QUERIES + ("overlaps",))
 
-# Combine the lists
-detail = gcal_calendar + ppm_timesheet + ppm_worked_hours + gcal_splits
+    # Write the detail while summarizing it by project
+    writers = ReportWriters(_args.format.split(","))
+    summary = Summary()
+    writers.write_sheet(
+        "detail", ["Project", "Notes", "Date", "Hours", "Source"], summary.tally(ReportEngine.merge(queries))
+    )
 
-# Sort the detail list by date ascending, source ascending and project ascending
-detail.sort(key=lambda x: (x[2], x[4], x[0]))
+    # Write overlapping events and timesheet entries
+    overlaps = queries["overlaps"].result()
+    writers.write_sheet(
+        "overlaps",
+        [
+            "Date", "Minutes",
+            "Source", "Project", "Notes", "Start", "End",
+            "Overlap Source", "Overlap Project", "Overlap Notes", "Overlap Start", "Overlap End"
+        ],
+        overlaps
+    )
 
-# Write detail list to text file detail.csv
-with open("detail.csv", "w", encoding="UTF-8", newline="") as f:
-    writer = csv.writer(f)
-    writer.writerow(["Project", "Notes", "Date", "Hours", "Source"])
-    writer.writerows(detail)
+    if overlaps:
+        print(f"Found {len(overlaps)} overlapping entries, please check the overlaps report")
 
-# Create a dictionary to hold the summary
-summary = {}
+    # Write summary
+    writers.write_sheet("summary", ["Project", "Hours"], summary_rows(summary.totals()))
+    writers.close()
 
-# Loop through the detail list and add to summary dictionary
-for item in detail:
-    # Skip worked hours
-    if item[0] == "WORKED HOURS":
-        continue
-    if item[0] in summary:
-        summary[item[0]] += item[3]
-    else:
-        summary[item[0]] = item[3]
+    # Close the database connections
+    engine.close()
+    gcal.util.disconnect_db()
+    ppm.util.disconnect_db()
 
-# Convert summary dictionary to list
-summary = list(summary.items())
+    # Open the detail and summary
+    if not _args.no_open:
+        writers.open_files(["detail", "summary"])
 
-# Sort the summary list by project ascending
-summary.sort(key=lambda x: x[0])
+def summary_rows(_totals):
+    """Summary rows followed by the difference when total hours is greater than worked hours
 
-# Get total hours
-total_hours = 0
-for item in summary:
-    total_hours += item[1]
+    Args:
+        _totals (dict): summary from Summary.totals()
 
-# Get worked hours
-worked_hours = 0
-for item in ppm_worked_hours:
-    worked_hours += item[3]
+    Yields:
+        list: (project, hours)
+    """
+    total_hours = _totals["total_hours"]
+    worked_hours = _totals["worked_hours"]
 
-# Write summary list to text file summary.csv
-with open("summary.csv", "w", encoding="UTF-8", newline="") as f:
-    writer = csv.writer(f)
-    writer.writerow(["Project", "Hours"])
-    writer.writerows(summary)
+    yield from _totals["summary"]
 
     # If total hours is greater than worked hours add a row
     if total_hours > worked_hours:
-        writer.writerow([">>>>>>>>>>>>", ""])
-        writer.writerow(["Total Hours", total_hours])
-        writer.writerow(["Worked Hours", worked_hours])
-        writer.writerow(["<<<<<<<<<<<<", ""])
-        writer.writerow(["Difference", total_hours - worked_hours])
+        yield [">>>>>>>>>>>>", None]
+        yield ["Total Hours", total_hours]
+        yield ["Worked Hours", worked_hours]
+        yield ["<<<<<<<<<<<<", None]
+        yield ["Difference", total_hours - worked_hours]
         print("Total hours is greater than worked hours by " + str(total_hours - worked_hours) + " hours")
-        print("Please check the detail.csv file for details and correct the problem")
-
-# Close the database connections
-gcal.util.disconnect_db()
-ppm.util.disconnect_db()
-
-# Open the detail.csv file
-os.startfile("detail.csv")
+        print("Please check the detail report for details and correct the problem")
 
-# Open the summary.csv file
-os.startfile("summary.csv")
+if __name__ == "__main__":
+    # Guarded so worker processes can import this module without running it
+    main()
@@ -0,0 +1,278 @@
+"""Invoice Processor Report Module:
+    Running independent report queries concurrently on read-only connections
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import os
+import queue
+import threading
+import weakref
+from export_modules.util import ExportUtil
+from report_modules.report import Report
+
+# Report streams merged into the invoice detail
+DETAIL_QUERIES = ("gcal_calendar", "ppm_timesheet", "ppm_worked_hours", "gcal_splits")
+
+# Report queries that attach the archives themselves
+ATTACHED_QUERIES = ("gcal_titles", "ppm_projects", "overlaps")
+
+class QueryStream:
+    """Query stream class:
+        - Runs one detail query on its own thread and read-only connections
+        - Hands rows over in chunks through a bounded queue so memory stays flat
+    """
+    # Sent after the last chunk
+    DONE = object()
+
+    def __init__(self, _engine, _name, _date, _chunk_size=1000, _chunks=16):
+        self._engine = _engine
+        self._name = _name
+        self._date = _date
+        self._chunk_size = _chunk_size
+        self._queue = queue.Queue(maxsize=_chunks)
+        self._stop = threading.Event()
+        _engine.streams.add(self)
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def run(self):
+        """Read the query into the queue, stopping early when the stream is closed
+        """
+        report = None
+        rows = None
+        try:
+            report = self._engine.open_report()
+            rows = self._engine.rows(report, self._name, self._date)
+            chunk = []
+            for row in rows:
+                chunk.append(row)
+                if len(chunk) >= self._chunk_size:
+                    if not self.put(chunk):
+                        return
+                    chunk = []
+            if chunk and not self.put(chunk):
+                return
+            self.put(self.DONE)
+        except Exception as error: # pylint: disable=broad-except
+            self.put(error)
+        finally:
+            # Detach before the connections close
+            if rows is not None:
+                rows.close()
+            if report is not None:
+                report.gcal_util.disconnect_db()
+                report.ppm_util.disconnect_db()
+
+    def put(self, _item):
+        """Queue an item, waiting for the reader to catch up
+
+        Args:
+            _item (object): chunk of rows, DONE or an exception
+
+        Returns:
+            bool: False when the reader was closed
+        """
+        while not self._stop.is_set():
+            try:
+                self._queue.put(_item, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def result(self):
+        """Rows as the query produces them
+
+        Yields:
+            list: query rows
+        """
+        try:
+            while True:
+                item = self._queue.get()
+                if item is self.DONE:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                yield from item
+        finally:
+            self.close()
+
+    def close(self):
+        """Stop the query, its thread closes the connections
+        """
+        self._stop.set()
+        self._engine.streams.discard(self)
+
+class ReportEngine:
+    """Report engine class:
+        - Read-only, memory-mapped connections to the GCal and PPM databases
+        - Runs independent report queries concurrently, any number of periods at once
+        - Streams each detail query into the merge as its rows arrive
+    """
+    def __init__(self, _gcal_db="gcal.db", _ppm_db="ppm.db", _workers=None, _mmap_size=268435456):
+        self._gcal_db = _gcal_db
+        self._ppm_db = _ppm_db
+        self._mmap_size = _mmap_size
+        self._executor = ThreadPoolExecutor(max_workers=_workers or os.cpu_count())
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._utils = []
+        self.streams = weakref.WeakSet()
+
+    def connect(self, _db):
+        """Open a read-only connection with memory-mapped I/O
+
+        Args:
+            _db (str): sqlite database name
+
+        Returns:
+            ExportUtil: connected util
+        """
+        util = ExportUtil()
+        util.connect_db(_db, True)
+        util.db_cur.execute(f"PRAGMA mmap_size = {int(self._mmap_size)}")
+        return util
+
+    def open_report(self):
+        """Open a report on new read-only connections
+
+        Returns:
+            Report: report on its own connections
+        """
+        return Report(self.connect(self._gcal_db), self.connect(self._ppm_db), True)
+
+    def report(self):
+        """Get the report for this pool thread, connecting on first use
+
+        Returns:
+            Report: report on this thread's read-only connections
+        """
+        if not hasattr(self._local, "report"):
+            self._local.report = self.open_report()
+            with self._lock:
+                self._utils += [self._local.report.gcal_util, self._local.report.ppm_util]
+        return self._local.report
+
+    @staticmethod
+    def rows(_report, _name, _date):
+        """Run a report query for a period
+
+        Args:
+            _report (Report): report on the connections to use
+            _name (str): Report method name
+            _date (date): date in the period
+
+        Yields:
+            list: query rows
+        """
+        _report.gcal_util.set_dates(_date)
+        _report.ppm_util.set_dates(_date)
+        if _name in ATTACHED_QUERIES:
+            yield from getattr(_report, _name)()
+            return
+
+        _report.attach_archives()
+        try:
+            yield from getattr(_report, _name)()
+        finally:
+            _report.detach_archives()
+
+    def query(self, _name, _date):
+        """Run a report query that returns a list on this pool thread's connections
+
+        Args:
+            _name (str): Report method name
+            _date (date): date in the period
+
+        Returns:
+            list: query rows
+        """
+        return list(self.rows(self.report(), _name, _date))
+
+    def submit(self, _date, _queries=DETAIL_QUERIES):
+        """Start report queries for a period
+
+        Detail queries stream on their own thread and connections, the others run in the pool.
+
+        Args:
+            _date (date): date in the period
+            _queries (list): Report method names
+
+        Returns:
+            dict: query name and future or QueryStream, both with result()
+        """
+        return {
+            name: (
+                QueryStream(self, name, _date) if name in DETAIL_QUERIES
+                else self._executor.submit(self.query, name, _date)
+            )
+            for name in _queries
+        }
+
+    @staticmethod
+    def merge(_futures):
+        """Merge the detail queries of a period as their rows arrive
+
+        Args:
+            _futures (dict): futures from submit()
+
+        Yields:
+            list: (project, notes, date, hours, source) sorted by date, source and project
+        """
+        try:
+            yield from Report.merge(*(_futures[name].result() for name in DETAIL_QUERIES))
+        finally:
+            ReportEngine.cancel(_futures)
+
+    @staticmethod
+    def cancel(_futures):
+        """Stop queries that are no longer needed
+
+        Args:
+            _futures (dict): futures from submit()
+        """
+        for future in _futures.values():
+            if isinstance(future, QueryStream):
+                future.close()
+            else:
+                future.cancel()
+
+    def detail(self, _date):
+        """Invoice detail for a period
+
+        Args:
+            _date (date): date in the period
+
+        Returns:
+            iterator: (project, notes, date, hours, source) sorted by date, source and project
+        """
+        return self.merge(self.submit(_date))
+
+    def details(self, _dates):
+        """Invoice detail for several periods with every query running at once
+
+        Each stream buffers a bounded number of rows until its period is read.
+
+        Args:
+            _dates (list): a date in each period
+
+        Yields:
+            iterator: detail for each period, close this generator to stop the periods not read
+        """
+        futures = [self.submit(run_date) for run_date in _dates]
+        try:
+            for period_futures in futures:
+                yield self.merge(period_futures)
+        finally:
+            for period_futures in futures:
+                self.cancel(period_futures)
+
+    def close(self):
+        """Stop open streams, wait for running queries and close every connection
+        """
+        for stream in list(self.streams):
+            stream.close()
+        self._executor.shutdown()
+        with self._lock:
+            for util in self._utils:
+                util.disconnect_db()
+            self._utils = []
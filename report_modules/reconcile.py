@@ -0,0 +1,107 @@
+"""Invoice Processor Report Module:
+    Reconciling overlapping calendar events and timesheet entries
+"""
+
+from datetime import datetime, timedelta
+import heapq
+
+class Reconcile:
+    """Reconcile class:
+        - Timed calendar events that overlap each other
+        - Calendar events already covered by a timesheet entry for the same invoice project
+    """
+    @staticmethod
+    def parse_time(_time):
+        """Parse a GCal time to an aware datetime in its own offset so events in
+        different time zones compare correctly
+
+        Args:
+            _time (str): ISO 8601 date time
+
+        Returns:
+            datetime: aware date time, local time when it has no offset
+        """
+        parsed = datetime.fromisoformat(_time.replace("Z", "+00:00"))
+        if parsed.tzinfo is None:
+            parsed = parsed.astimezone()
+        return parsed
+
+    @staticmethod
+    def overlaps(_gcal_events, _ppm_entries):
+        """Find overlapping pairs with a sweep-line over the calendar events sorted once by start
+
+        Timesheet entries have no time of day so they are looked up by day and project
+        instead of being swept, the day of an event is its own date as in the detail.
+        Each entry's hours are used up by the meetings it covers in start order.
+
+        Args:
+            _gcal_events (list): (project, notes, start, end) timed calendar events
+            _ppm_entries (list): (project, notes, date, hours) timesheet entries
+
+        Returns:
+            list: (date, minutes, source, project, notes, start, end,
+                   source, project, notes, start, end) sorted by date
+        """
+        events = sorted(
+            (Reconcile.parse_time(start), Reconcile.parse_time(end), "gcal", project, notes, start[:10])
+            for project, notes, start, end in _gcal_events
+        )
+
+        # Minutes left on each timesheet entry by day and project
+        coverage = {}
+        for project, notes, ppm_date, hours in _ppm_entries:
+            day = datetime.fromisoformat(ppm_date[:10])
+            coverage.setdefault((ppm_date[:10], project), []).append(
+                [(day, day + timedelta(days=1), "ppm", project, notes), hours * 60]
+            )
+
+        # Events still open at the sweep position, ordered by end
+        active = []
+        pairs = []
+        for index, current in enumerate(events):
+            while active and active[0][0] <= current[0]:
+                heapq.heappop(active)
+
+            for end, other_index in active:
+                other = events[other_index]
+                minutes = (min(end, current[1]) - current[0]).total_seconds() / 60
+                if minutes > 0:
+                    pairs.append(Reconcile.pair(current[5], minutes, other, current))
+
+            heapq.heappush(active, (current[1], index))
+
+            # Meeting time already on a timesheet entry for the same project
+            meeting = (current[1] - current[0]).total_seconds() / 60
+            for entry in coverage.get((current[5], current[3]), ()):
+                if meeting <= 0:
+                    break
+                minutes = min(meeting, entry[1])
+                if minutes <= 0:
+                    continue
+                entry[1] -= minutes
+                meeting -= minutes
+                pairs.append(Reconcile.pair(current[5], minutes, current, entry[0]))
+
+        # Events in different offsets can reach their own date out of order
+        pairs.sort(key=lambda x: x[0])
+        return pairs
+
+    @staticmethod
+    def pair(_date, _minutes, _first, _second):
+        """Format an overlapping pair
+
+        Args:
+            _date (str): day the overlap starts (YYYY-MM-DD)
+            _minutes (float): minutes overlapping
+            _first (tuple): (start, end, source, project, notes)
+            _second (tuple): (start, end, source, project, notes)
+
+        Returns:
+            tuple: (date, minutes, source, project, notes, start, end,
+                    source, project, notes, start, end)
+        """
+        return (
+            _date, round(_minutes),
+            _first[2], _first[3], _first[4], _first[0].isoformat(), _first[1].isoformat(),
+            _second[2], _second[3], _second[4], _second[0].isoformat(), _second[1].isoformat()
+        )
@@ -0,0 +1,501 @@
+"""Invoice Processor Report Module:
+    Building the invoice detail and summary from the GCal and PPM databases
+"""
+
+import heapq
+from export_modules.retention import Retention
+from report_modules.reconcile import Reconcile
+
+class Report:
+    """Invoice report class
+        - Project xref and ignore tables
+        - Distinct titles and projects that need mapping
+        - Invoice detail and summary for the dates set on each export module
+        - Archives attached only while a report for an archived period runs
+    """
+    def __init__(self, _gcal_util, _ppm_util, _read_only=False):
+        self.gcal_util = _gcal_util
+        self.ppm_util = _ppm_util
+        self.gcal_retention = Retention(self.gcal_util, "calendar")
+        self.ppm_retention = Retention(self.ppm_util, "timesheet")
+        if not _read_only:
+            self.create_tables()
+
+    def create_tables(self):
+        """Create xref and ignore tables if they don't exist
+        """
+        self.gcal_util.db_cur.execute(
+            """CREATE TABLE IF NOT EXISTS project_xref (
+                calendar TEXT,
+                gcal_title REAL,
+                inv_title REAL
+            )"""
+        )
+        self.gcal_util.db_cur.execute(
+            """CREATE TABLE IF NOT EXISTS ignore (
+                calendar TEXT,
+                title REAL,
+                flag TEXT
+            )"""
+        )
+        self.gcal_util.commit_db()
+
+        self.ppm_util.db_cur.execute(
+            """CREATE TABLE IF NOT EXISTS project_xref (
+                ppm_project TEXT,
+                inv_project TEXT
+            )"""
+        )
+        self.ppm_util.db_cur.execute(
+            """CREATE TABLE IF NOT EXISTS ignore (
+                project TEXT,
+                description TEXT,
+                flag TEXT
+            )"""
+        )
+
+        # Create index for joining timesheet entries to the ignore table if it doesn't exist
+        self.ppm_util.db_cur.execute(
+            """CREATE INDEX IF NOT EXISTS ignore_index ON ignore (project, description, flag)"""
+        )
+        self.ppm_util.commit_db()
+
+    def attach_archives(self):
+        """Attach archives when the period was moved out of the hot databases
+        """
+        gcal_dates = self.gcal_util.get_dates()
+        self.gcal_retention.attach(gcal_dates["fom_isoz"], gcal_dates["eom_isoz"])
+
+        ppm_dates = self.ppm_util.get_dates()
+        self.ppm_retention.attach(ppm_dates["fom"], ppm_dates["eom"])
+
+    def detach_archives(self):
+        """Detach archives attached by attach_archives()
+        """
+        self.gcal_retention.detach()
+        self.ppm_retention.detach()
+
+    def gcal_mappings(self):
+        """Calendar titles already mapped to an invoice project
+
+        *GCAL only applies to PPM projects so it is never suggested for a title.
+
+        Returns:
+            list: (title, invoice project)
+        """
+        self.gcal_util.db_cur.execute(
+            "SELECT gcal_title, inv_title FROM project_xref WHERE inv_title <> '*GCAL'"
+        )
+        return self.gcal_util.db_cur.fetchall()
+
+    def ppm_mappings(self):
+        """PPM projects already mapped to an invoice project
+
+        Returns:
+            list: (project, invoice project)
+        """
+        self.ppm_util.db_cur.execute("SELECT ppm_project, inv_project FROM project_xref")
+        return self.ppm_util.db_cur.fetchall()
+
+    def gcal_titles(self):
+        """Distinct calendar titles for timed events in the period
+
+        Returns:
+            list: (calendar, title)
+        """
+        gcal_dates = self.gcal_util.get_dates()
+        self.attach_archives()
+        try:
+            self.gcal_util.db_cur.execute(
+                """SELECT DISTINCT calendar, title FROM calendar WHERE start BETWEEN ? and ?
+                    AND SUBSTR(start,11,1) = 'T'
+                """,
+                (gcal_dates["fom_isoz"], gcal_dates["eom_isoz"])
+            )
+            return self.gcal_util.db_cur.fetchall()
+        finally:
+            self.detach_archives()
+
+    def ppm_projects(self):
+        """Distinct timesheet projects and descriptions in the period
+
+        Returns:
+            list: (project, description)
+        """
+        ppm_dates = self.ppm_util.get_dates()
+        self.attach_archives()
+        try:
+            self.ppm_util.db_cur.execute(
+                """SELECT DISTINCT
+                       project, description
+                   FROM timesheet
+                   WHERE date BETWEEN ? and ?
+                   AND total_hours IS NULL
+                """,
+                (ppm_dates["fom"], ppm_dates["eom"])
+            )
+            return self.ppm_util.db_cur.fetchall()
+        finally:
+            self.detach_archives()
+
+    def gcal_calendar(self):
+        """Calendar entries for the period joined to xref and ignore tables excluding any ignored
+
+        Yields:
+            list: (project, notes, date, hours, source) rounded up to the nearest 15 minutes,
+                ordered by date and project
+        """
+        gcal_dates = self.gcal_util.get_dates()
+        gcal_cur = self.gcal_util.db_conn.cursor()
+        gcal_cur.execute(
+            """SELECT
+                   TRIM(COALESCE(px.inv_title,ca.title)) as project,
+                   TRIM(ca.title) as notes,
+                   SUBSTR(ca.start,1,10) as date,
+                   case
+                        when SUBSTR(ca.start,11,1) = 'T' then
+                            ROUND(duration/60,2)
+                        else
+                            0
+                   end as hours,
+                   'gcal' as source
+                FROM calendar ca
+                LEFT OUTER JOIN project_xref px
+                ON ca.calendar = px.calendar AND ca.title = px.gcal_title
+                WHERE
+                ca.start BETWEEN ? and ?
+                AND (ca.calendar, ca.title) NOT IN (
+                    SELECT calendar, title FROM ignore WHERE flag = 'Y'
+                )
+                AND SUBSTR(ca.start,11,1) = 'T'
+                ORDER BY date, project
+                """,
+            (gcal_dates["fom_isoz"], gcal_dates["eom_isoz"])
+        )
+
+        # Loop through hours and round up to the nearest 15 minutes
+        for entry in gcal_cur:
+            if entry[3] % 0.25 != 0:
+                entry = list(entry)
+                print(f"Rounding up {entry[1]} on {entry[2]} from {entry[3]} to {round(entry[3] + 0.25 - (entry[3] % 0.25), 2)}")
+                # Round up to nearest 15 minutes
+                entry[3] = round(entry[3] + 0.25 - (entry[3] % 0.25), 2)
+            yield entry
+
+    def ppm_timesheet(self):
+        """Timesheet entries for the period joined to xref and ignore tables excluding any ignored
+
+        Returns:
+            iterator: (project, notes, date, hours, source) ordered by date and project
+        """
+        ppm_dates = self.ppm_util.get_dates()
+        ppm_cur = self.ppm_util.db_conn.cursor()
+        ppm_cur.execute(
+            """SELECT
+                    TRIM(COALESCE(px.inv_project, ts.project)) as project,
+                    TRIM(ts.description) as notes,
+                    SUBSTR(ts.date,1,10) as date,
+                    ts.hours as hours,
+                    'ppm' as source
+                FROM timesheet ts
+                LEFT OUTER JOIN project_xref px
+                ON ts.project = px.ppm_project
+                WHERE
+                ts.date BETWEEN ? and ?
+                AND (ts.project, ts.description) NOT IN (
+                    SELECT project, description FROM ignore WHERE flag = 'Y'
+                )
+                AND ts.total_hours IS NULL
+                AND COALESCE(px.inv_project, ts.project) <> '*GCAL'
+                ORDER BY date, project
+            """,
+            (ppm_dates["fom"], ppm_dates["eom"])
+        )
+        return ppm_cur
+
+    def ppm_worked_hours(self):
+        """PPM total hours per day less the ignored timesheet entries summed per day
+
+        Returns:
+            iterator: ('WORKED HOURS', notes, date, hours, source) ordered by date
+        """
+        ppm_dates = self.ppm_util.get_dates()
+        ppm_cur = self.ppm_util.db_conn.cursor()
+        ppm_cur.execute(
+            """ WITH ignored_hours AS (
+                    SELECT
+                        tx.date,
+                        SUM(tx.hours) as ignored_hours
+                    FROM timesheet tx
+                    JOIN ignore ig
+                    ON tx.project = ig.project
+                    AND tx.description = ig.description
+                    AND ig.flag = 'Y'
+                    WHERE tx.date BETWEEN ? and ?
+                    GROUP BY tx.date
+                )
+                SELECT
+                    'WORKED HOURS' as project,
+                    '************' as notes,
+                    SUBSTR(ts.date,1,10) as date,
+                    ts.total_hours - COALESCE(ih.ignored_hours, 0) as worked_hours,
+                    '************' as source
+                FROM timesheet ts
+                LEFT OUTER JOIN ignored_hours ih
+                ON ts.date = ih.date
+                WHERE
+                ts.date BETWEEN ? and ?
+                AND ts.total_hours IS NOT NULL
+                ORDER BY date
+            """,
+            (ppm_dates["fom"], ppm_dates["eom"], ppm_dates["fom"], ppm_dates["eom"])
+        )
+        return ppm_cur
+
+    def gcal_splits(self):
+        """Divide *GCAL timesheet entries between the All-day calendar events on the same day
+
+        Yields:
+            list: (project, notes, date, hours, source) ordered by date, source and project
+        """
+        ppm_dates = self.ppm_util.get_dates()
+        ppm_cur = self.ppm_util.db_conn.cursor()
+        ppm_cur.execute(
+            """ SELECT
+                    TRIM(COALESCE(px.inv_project, ts.project)) as project,
+                    TRIM(ts.description) as notes,
+                    SUBSTR(ts.date,1,10) as date,
+                    ts.hours as hours,
+                    'ppm' as source
+                FROM timesheet ts
+                LEFT OUTER JOIN project_xref px
+                ON ts.project = px.ppm_project
+                WHERE
+                ts.date BETWEEN ? and ?
+                AND (ts.project, ts.description) NOT IN (
+                    SELECT project, description FROM ignore WHERE flag = 'Y'
+                )
+                AND COALESCE(px.inv_project, ts.project) = '*GCAL'
+                ORDER BY date
+            """,
+            (ppm_dates["fom"], ppm_dates["eom"])
+        )
+        gcal_splits = []
+
+        # Loop through gcal_ppm_splits and find matching gcal entries
+        for entry in ppm_cur:
+            # Splits are sorted one day at a time
+            if gcal_splits and gcal_splits[0][2] != entry[2]:
+                gcal_splits.sort(key=lambda x: (x[4], x[0]))
+                yield from gcal_splits
+                gcal_splits = []
+
+            self.gcal_util.db_cur.execute(
+                """ SELECT
+                        COALESCE(px.inv_title, ca.title) as title,
+                        ca.title as notes
+                    FROM
+                        calendar ca
+                        LEFT OUTER JOIN project_xref px
+                        ON ca.calendar = px.calendar
+                        AND ca.title = px.gcal_title
+                    WHERE
+                        ? between ca.start and ca.end
+                        AND SUBSTR(ca.start,11,1) <> 'T'
+                        AND (ca.calendar, ca.title) NOT IN (
+                            SELECT calendar, title FROM ignore WHERE flag = 'Y'
+                        )
+                """,
+                (entry[2],)
+            )
+            gcal_entries = self.gcal_util.db_cur.fetchall()
+
+            split_hours = 0
+
+            # Loop through gcal_entries and add to gcal_splits
+            for gcal_entry in gcal_entries:
+                # Divide hours from entry[3] by number of gcal_entries
+                hours = entry[3] / len(gcal_entries)
+
+                # Round hours to nearest 15 minutes
+                if hours % 0.25 != 0:
+                    hours = round(hours + 0.25 - (hours % 0.25), 2)
+
+                # Cap hours at ppm entry hours
+                if split_hours + hours > entry[3]:
+                    hours = entry[3] - split_hours
+
+                # Add hours to split_hours
+                split_hours += hours
+
+                gcal_splits.append([gcal_entry[0], gcal_entry[1], entry[2], hours, "*gcal"])
+
+            if len(gcal_entries) == 0:
+                print("No matching gcal entry for " + entry[1] + " on " + entry[2])
+
+                # Add entry to gcal_splits
+                gcal_splits.append([entry[0], entry[1], entry[2], entry[3], "ppm"])
+
+        gcal_splits.sort(key=lambda x: (x[4], x[0]))
+        yield from gcal_splits
+
+    def detail(self):
+        """Combine all sources into the invoice detail
+
+        Each source is already ordered so they are merged as they are read instead of
+        building and sorting the whole list in memory.
+
+        Yields:
+            list: (project, notes, date, hours, source) sorted by date, source and project
+        """
+        self.attach_archives()
+        try:
+            yield from self.merge(
+                self.gcal_calendar(),
+                self.ppm_timesheet(),
+                self.ppm_worked_hours(),
+                self.gcal_splits()
+            )
+        finally:
+            self.detach_archives()
+
+    @staticmethod
+    def merge(*_sources):
+        """Merge detail sources that are each already ordered
+
+        Args:
+            _sources (iterable): detail rows ordered by date, source and project
+
+        Returns:
+            iterator: (project, notes, date, hours, source) sorted by date, source and project
+        """
+        # Merge the sources by date ascending, source ascending and project ascending
+        return heapq.merge(*_sources, key=lambda x: (x[2], x[4], x[0]))
+
+    def overlaps(self):
+        """Find calendar events that overlap each other or are covered by a timesheet entry
+
+        Returns:
+            list: overlapping pairs from Reconcile.overlaps()
+        """
+        gcal_dates = self.gcal_util.get_dates()
+        ppm_dates = self.ppm_util.get_dates()
+        self.attach_archives()
+        try:
+            self.gcal_util.db_cur.execute(
+                """SELECT
+                       TRIM(COALESCE(px.inv_title,ca.title)) as project,
+                       TRIM(ca.title) as notes,
+                       ca.start,
+                       ca.end
+                    FROM calendar ca
+                    LEFT OUTER JOIN project_xref px
+                    ON ca.calendar = px.calendar AND ca.title = px.gcal_title
+                    WHERE
+                    ca.start BETWEEN ? and ?
+                    AND (ca.calendar, ca.title) NOT IN (
+                        SELECT calendar, title FROM ignore WHERE flag = 'Y'
+                    )
+                    AND SUBSTR(ca.start,11,1) = 'T'
+                """,
+                (gcal_dates["fom_isoz"], gcal_dates["eom_isoz"])
+            )
+            gcal_events = self.gcal_util.db_cur.fetchall()
+
+            self.ppm_util.db_cur.execute(
+                """SELECT
+                        TRIM(COALESCE(px.inv_project, ts.project)) as project,
+                        TRIM(ts.description) as notes,
+                        SUBSTR(ts.date,1,10) as date,
+                        ts.hours as hours
+                    FROM timesheet ts
+                    LEFT OUTER JOIN project_xref px
+                    ON ts.project = px.ppm_project
+                    WHERE
+                    ts.date BETWEEN ? and ?
+                    AND (ts.project, ts.description) NOT IN (
+                        SELECT project, description FROM ignore WHERE flag = 'Y'
+                    )
+                    AND ts.total_hours IS NULL
+                    AND COALESCE(px.inv_project, ts.project) <> '*GCAL'
+                """,
+                (ppm_dates["fom"], ppm_dates["eom"])
+            )
+            ppm_entries = self.ppm_util.db_cur.fetchall()
+        finally:
+            self.detach_archives()
+
+        return Reconcile.overlaps(gcal_events, ppm_entries)
+
+    @staticmethod
+    def summary(_detail):
+        """Summarize invoice detail by project
+
+        Args:
+            _detail (iterable): invoice detail from detail()
+
+        Returns:
+            dict: summary list of (project, hours), total hours and worked hours
+        """
+        summary = Summary()
+        for item in _detail:
+            summary.add(item)
+        return summary.totals()
+
+class Summary:
+    """Running summary of invoice detail by project
+        so the detail can be written as it streams
+    """
+    def __init__(self):
+        # Create a dictionary to hold the summary
+        self._summary = {}
+
+        # Get worked hours
+        self.worked_hours = 0
+
+    def add(self, _item):
+        """Add a detail row to the summary
+
+        Args:
+            _item (list): (project, notes, date, hours, source)
+        """
+        # Skip worked hours
+        if _item[0] == "WORKED HOURS":
+            self.worked_hours += _item[3]
+        elif _item[0] in self._summary:
+            self._summary[_item[0]] += _item[3]
+        else:
+            self._summary[_item[0]] = _item[3]
+
+    def tally(self, _detail):
+        """Pass detail rows through while adding them to the summary
+
+        Args:
+            _detail (iterable): invoice detail from Report.detail()
+
+        Yields:
+            list: each detail row
+        """
+        for item in _detail:
+            self.add(item)
+            yield item
+
+    def totals(self):
+        """Get the summary
+
+        Returns:
+            dict: summary list of (project, hours), total hours and worked hours
+        """
+        # Convert summary dictionary to list sorted by project ascending
+        summary = sorted(self._summary.items(), key=lambda x: x[0])
+
+        # Get total hours
+        total_hours = 0
+        for item in summary:
+            total_hours += item[1]
+
+        return {
+            "summary": summary,
+            "total_hours": total_hours,
+            "worked_hours": self.worked_hours
+        }
@@ -0,0 +1,185 @@
+"""Invoice Processor Report Module:
+    Long-running sync daemon serving the invoice detail and summary over a local HTTP API
+"""
+
+from contextlib import closing
+from datetime import date, datetime, timedelta
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import parse_qs, urlparse
+import json
+import time
+from report_modules.engine import ReportEngine
+from report_modules.report import Report
+
+class Server:
+    """Sync daemon class:
+        - Keeps the GCal and PPM databases and Google session open between syncs
+        - Syncs recent months on a schedule
+        - Serves detail and summary for any period, cached until the next sync
+    """
+    def __init__(self, _gcal, _ppm, _interval=60, _months=2, _sync_ppm=True):
+        self.gcal = _gcal
+        self.ppm = _ppm
+        self._sync_ppm = _sync_ppm
+        self.report = Report(self.gcal.util, self.ppm.util)
+        self.engine = ReportEngine(self.gcal.util.db_name, self.ppm.util.db_name)
+        self._interval = _interval * 60
+        self._months = _months
+        self._cache = {}
+        self._last_sync = None
+        self._next_sync = 0
+
+    def sync(self):
+        """Export the most recent months from each source and clear the cache
+        """
+        first_of_month = date.today().replace(day=1)
+        run_dates = []
+        for _month in range(self._months):
+            run_date = datetime.combine(first_of_month, datetime.min.time())
+            run_dates.append(run_date)
+            for name, source in (("Google Calendar", self.gcal), ("PPM", self.ppm)):
+                if source is self.ppm and not self._sync_ppm:
+                    continue
+                # Keep serving when a sync fails, the next sync will try again
+                try:
+                    if source.export(run_date):
+                        print(f"Synced {name} {run_date.strftime('%Y-%m')}")
+                    else:
+                        print(f"Sync of {name} {run_date.strftime('%Y-%m')} failed")
+                except Exception as error: # pylint: disable=broad-except
+                    print(f"Sync of {name} {run_date.strftime('%Y-%m')} failed: {error}")
+            first_of_month = (first_of_month - timedelta(days=1)).replace(day=1)
+
+        self._cache.clear()
+        self._last_sync = datetime.now()
+        self._next_sync = time.time() + self._interval
+
+        # Warm the cache for the synced months, querying them all at once
+        try:
+            with closing(self.engine.details(run_dates)) as details:
+                for run_date, detail in zip(run_dates, details):
+                    self.cache(run_date.strftime("%Y-%m"), list(detail))
+        except Exception as error: # pylint: disable=broad-except
+            # Keep serving, periods not cached are queried when requested
+            print(f"Caching synced months failed: {error}")
+
+    def query(self, _endpoint, _period):
+        """Get the detail or summary for a period from the cache or the live databases
+
+        Args:
+            _endpoint (str): detail or summary
+            _period (str): month to report (YYYY-MM)
+
+        Returns:
+            dict: JSON serializable response
+        """
+        if (_endpoint, _period) in self._cache:
+            return self._cache[(_endpoint, _period)]
+
+        run_date = datetime.strptime(_period + "-01", "%Y-%m-%d")
+        self.cache(_period, list(self.engine.detail(run_date)))
+
+        return self._cache[(_endpoint, _period)]
+
+    def cache(self, _period, _detail):
+        """Cache the detail and summary responses for a period
+
+        Args:
+            _period (str): month reported (YYYY-MM)
+            _detail (list): invoice detail rows
+        """
+        totals = Report.summary(_detail)
+
+        self._cache[("detail", _period)] = {
+            "period": _period,
+            "detail": [
+                {"project": row[0], "notes": row[1], "date": row[2], "hours": row[3], "source": row[4]}
+                for row in _detail
+            ]
+        }
+        self._cache[("summary", _period)] = {
+            "period": _period,
+            "summary": [{"project": row[0], "hours": row[1]} for row in totals["summary"]],
+            "total_hours": totals["total_hours"],
+            "worked_hours": totals["worked_hours"]
+        }
+
+    def status(self):
+        """Get the sync status
+
+        Returns:
+            dict: JSON serializable response
+        """
+        return {
+            "last_sync": self._last_sync.isoformat() if self._last_sync else None,
+            "next_sync": datetime.fromtimestamp(self._next_sync).isoformat(),
+            "cached": len(self._cache),
+            "google_api": self.gcal.quota.stats
+        }
+
+    def run(self, _host="127.0.0.1", _port=8765):
+        """Serve requests and sync on schedule until interrupted
+
+        Requests and syncs share one thread so the sqlite connections are never used concurrently,
+        report queries run on the engine's own read-only connections.
+
+        Args:
+            _host (str): address to listen on
+            _port (int): port to listen on
+        """
+        httpd = HTTPServer((_host, _port), ServerRequestHandler)
+        httpd.daemon = self
+        print(f"Serving on http://{_host}:{_port} (GET /detail, /summary, /status)")
+
+        try:
+            while True:
+                if time.time() >= self._next_sync:
+                    self.sync()
+                httpd.timeout = max(self._next_sync - time.time(), 0)
+                httpd.handle_request()
+        except KeyboardInterrupt:
+            print("Stopping server")
+        finally:
+            httpd.server_close()
+            self.engine.close()
+
+class ServerRequestHandler(BaseHTTPRequestHandler):
+    """HTTP request handler for the sync daemon
+        - /detail?period=YYYY-MM
+        - /summary?period=YYYY-MM
+        - /status
+    """
+    def do_GET(self): # pylint: disable=invalid-name
+        """Handle GET requests
+        """
+        url = urlparse(self.path)
+        endpoint = url.path.strip("/")
+        period = parse_qs(url.query).get("period", [None])[0]
+
+        # Default to last month
+        if period is None:
+            period = (date.today().replace(day=1) - timedelta(days=1)).strftime("%Y-%m")
+
+        if endpoint == "status":
+            self.send_json(200, self.server.daemon.status())
+        elif endpoint in ("detail", "summary"):
+            try:
+                self.send_json(200, self.server.daemon.query(endpoint, period))
+            except ValueError:
+                self.send_json(400, {"error": f"Invalid period {period}, expected YYYY-MM"})
+        else:
+            self.send_json(404, {"error": f"Unknown endpoint {url.path}"})
+
+    def send_json(self, _status, _body):
+        """Send a JSON response
+
+        Args:
+            _status (int): HTTP status code
+            _body (dict): response body
+        """
+        response = json.dumps(_body).encode("utf-8")
+        self.send_response(_status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
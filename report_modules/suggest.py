@@ -0,0 +1,69 @@
+"""Invoice Processor Report Module:
+    Suggesting invoice projects for new calendar titles and PPM projects
+"""
+
+class Suggest:
+    """Suggestion index class:
+        - In-memory inverted index of character trigrams over mapped titles
+        - Ranks invoice projects by trigram similarity to a new title
+    """
+    def __init__(self, _mappings=()):
+        self._titles = []
+        self._index = {}
+        for title, inv_project in _mappings:
+            self.add(title, inv_project)
+
+    @staticmethod
+    def trigrams(_text):
+        """Character trigrams of a title, padded so short words still match
+
+        Args:
+            _text (str): title
+
+        Returns:
+            set: trigrams
+        """
+        text = f"  {' '.join(str(_text).lower().split())} "
+        return {text[i:i + 3] for i in range(len(text) - 2)}
+
+    def add(self, _title, _inv_project):
+        """Add a mapped title to the index
+
+        Args:
+            _title (str): calendar title or PPM project
+            _inv_project (str): invoice project it is mapped to
+        """
+        trigrams = self.trigrams(_title)
+        title_id = len(self._titles)
+        self._titles.append((_inv_project, len(trigrams)))
+        for trigram in trigrams:
+            self._index.setdefault(trigram, []).append(title_id)
+
+    def suggest(self, _title, _limit=3, _min_score=0.3):
+        """Rank invoice projects for a new title
+
+        Args:
+            _title (str): calendar title or PPM project
+            _limit (int): number of suggestions
+            _min_score (float): minimum similarity (0-1)
+
+        Returns:
+            list: (invoice project, score) best first
+        """
+        trigrams = self.trigrams(_title)
+
+        # Count trigrams shared with each mapped title through the index
+        shared = {}
+        for trigram in trigrams:
+            for title_id in self._index.get(trigram, ()):
+                shared[title_id] = shared.get(title_id, 0) + 1
+
+        # Dice coefficient, keeping the best title for each invoice project
+        scores = {}
+        for title_id, count in shared.items():
+            inv_project, size = self._titles[title_id]
+            score = 2 * count / (len(trigrams) + size)
+            if score >= _min_score and score > scores.get(inv_project, 0):
+                scores[inv_project] = score
+
+        return sorted(scores.items(), key=lambda x: (-x[1], x[0]))[:_limit]
@@ -0,0 +1,282 @@
+"""Invoice Processor Report Module:
+    Writing report sheets as CSV, XLSX, Parquet or JSON Lines from row iterators
+"""
+
+import csv
+import json
+import os
+import subprocess
+import sys
+from openpyxl import Workbook
+
+# Optional dependency for parquet output
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+# Columns written as numbers, everything else is text
+NUMERIC_COLUMNS = ("Hours", "Minutes")
+
+class CsvWriter:
+    """CSV writer class:
+        One csv file per sheet
+    """
+    openable = True
+
+    def __init__(self, _path):
+        self._path = _path
+        self.paths = {}
+        self._file = None
+        self._writer = None
+
+    def start_sheet(self, _sheet, _header):
+        """Start a sheet
+
+        Args:
+            _sheet (str): sheet name
+            _header (list): column names
+        """
+        self.paths[_sheet] = os.path.join(self._path, f"{_sheet}.csv")
+        self._file = open(self.paths[_sheet], "w", encoding="UTF-8", newline="")
+        self._writer = csv.writer(self._file)
+        self._writer.writerow(_header)
+
+    def write_row(self, _row):
+        """Write a row to the current sheet
+
+        Args:
+            _row (list): column values
+        """
+        self._writer.writerow(_row)
+
+    def end_sheet(self):
+        """Finish the current sheet
+        """
+        self._file.close()
+
+    def close(self):
+        """Finish writing
+        """
+
+class XlsxWriter:
+    """XLSX writer class:
+        One workbook with a sheet per report sheet, written in streaming write-only mode
+    """
+    openable = True
+
+    def __init__(self, _path):
+        self._path = os.path.join(_path, "report.xlsx")
+        self.paths = {}
+        self._workbook = Workbook(write_only=True)
+        self._sheet = None
+
+    def start_sheet(self, _sheet, _header):
+        """Start a sheet
+
+        Args:
+            _sheet (str): sheet name
+            _header (list): column names
+        """
+        self.paths[_sheet] = self._path
+        self._sheet = self._workbook.create_sheet(_sheet.title())
+        self._sheet.append(_header)
+
+    def write_row(self, _row):
+        """Write a row to the current sheet
+
+        Args:
+            _row (list): column values
+        """
+        self._sheet.append(list(_row))
+
+    def end_sheet(self):
+        """Finish the current sheet
+        """
+        self._sheet = None
+
+    def close(self):
+        """Finish writing
+        """
+        self._workbook.save(self._path)
+
+class ParquetWriter:
+    """Parquet writer class:
+        One parquet file per sheet, written in row groups
+    """
+    openable = False
+    batch_size = 10000
+
+    def __init__(self, _path):
+        if pyarrow is None:
+            raise ImportError("Parquet output needs pyarrow (pip install pyarrow)")
+        self._path = _path
+        self.paths = {}
+        self._header = None
+        self._schema = None
+        self._writer = None
+        self._batch = []
+
+    def start_sheet(self, _sheet, _header):
+        """Start a sheet
+
+        Args:
+            _sheet (str): sheet name
+            _header (list): column names
+        """
+        self.paths[_sheet] = os.path.join(self._path, f"{_sheet}.parquet")
+        self._header = _header
+        self._schema = pyarrow.schema([
+            (column, pyarrow.float64() if column in NUMERIC_COLUMNS else pyarrow.string())
+            for column in _header
+        ])
+        self._writer = pyarrow.parquet.ParquetWriter(self.paths[_sheet], self._schema)
+
+    def write_row(self, _row):
+        """Write a row to the current sheet
+
+        Args:
+            _row (list): column values
+        """
+        self._batch.append(_row)
+        if len(self._batch) >= self.batch_size:
+            self.write_batch()
+
+    def write_batch(self):
+        """Write buffered rows as a row group
+        """
+        columns = []
+        for index, column in enumerate(self._header):
+            cast = float if column in NUMERIC_COLUMNS else str
+            columns.append([None if row[index] is None else cast(row[index]) for row in self._batch])
+        self._writer.write_table(pyarrow.Table.from_arrays(columns, schema=self._schema))
+        self._batch = []
+
+    def end_sheet(self):
+        """Finish the current sheet
+        """
+        if self._batch:
+            self.write_batch()
+        self._writer.close()
+
+    def close(self):
+        """Finish writing
+        """
+
+class JsonLinesWriter:
+    """JSON Lines writer class:
+        One jsonl file per sheet with an object per row
+    """
+    openable = False
+
+    def __init__(self, _path):
+        self._path = _path
+        self.paths = {}
+        self._header = None
+        self._file = None
+
+    def start_sheet(self, _sheet, _header):
+        """Start a sheet
+
+        Args:
+            _sheet (str): sheet name
+            _header (list): column names
+        """
+        self.paths[_sheet] = os.path.join(self._path, f"{_sheet}.jsonl")
+        self._header = [column.lower().replace(" ", "_") for column in _header]
+        self._file = open(self.paths[_sheet], "w", encoding="UTF-8")
+
+    def write_row(self, _row):
+        """Write a row to the current sheet
+
+        Args:
+            _row (list): column values
+        """
+        self._file.write(json.dumps(dict(zip(self._header, _row))) + "\n")
+
+    def end_sheet(self):
+        """Finish the current sheet
+        """
+        self._file.close()
+
+    def close(self):
+        """Finish writing
+        """
+
+# Output formats by name
+WRITERS = {
+    "csv": CsvWriter,
+    "xlsx": XlsxWriter,
+    "parquet": ParquetWriter,
+    "jsonl": JsonLinesWriter
+}
+
+class ReportWriters:
+    """Report writers class:
+        Writes each sheet once to every requested output format
+    """
+    def __init__(self, _formats, _path="."):
+        self._writers = []
+        for output_format in _formats:
+            if output_format not in WRITERS:
+                print(f"Unknown output format {output_format}, expected one of {', '.join(WRITERS)}")
+                continue
+            try:
+                self._writers.append(WRITERS[output_format](_path))
+            except ImportError as error:
+                print(error)
+
+    def write_sheet(self, _sheet, _header, _rows):
+        """Write a sheet from a row iterator to every writer in a single pass
+
+        Args:
+            _sheet (str): sheet name
+            _header (list): column names
+            _rows (iterable): rows to write
+        """
+        for writer in self._writers:
+            writer.start_sheet(_sheet, _header)
+        for row in _rows:
+            for writer in self._writers:
+                writer.write_row(row)
+        for writer in self._writers:
+            writer.end_sheet()
+
+    def close(self):
+        """Finish every writer
+        """
+        for writer in self._writers:
+            writer.close()
+
+    def open_files(self, _sheets):
+        """Open written sheets in the default spreadsheet application
+
+        Args:
+            _sheets (list): sheet names to open
+        """
+        opened = []
+        for writer in self._writers:
+            if not writer.openable:
+                continue
+            for sheet in _sheets:
+                path = writer.paths.get(sheet)
+                if path is not None and path not in opened:
+                    open_file(path)
+                    opened.append(path)
+
+def open_file(_path):
+    """Open a file with the default application for this platform
+
+    Args:
+        _path (str): path to file
+    """
+    try:
+        if sys.platform == "win32":
+            os.startfile(_path) # pylint: disable=no-member
+        elif sys.platform == "darwin":
+            subprocess.Popen(["open", _path])
+        else:
+            subprocess.Popen(["xdg-open", _path], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    except OSError as error:
+        print(f"Could not open {_path}: {error}")